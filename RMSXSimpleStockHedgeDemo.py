@@ -1,8 +1,23 @@
 # RMSXSimpleStockHedgeDemo.py
 
+import abc
 import argparse
 from datetime import datetime
+import fnmatch
+import heapq
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
 import logging
+import mmap
+import os
+import queue
+import re
+import struct
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from easymsx.easymsx import EasyMSX
 from easymsx.notification import Notification as EasyMSXNotification
 from easymkt.easymkt import EasyMKT
@@ -12,42 +27,2028 @@ from rulemsx.action import Action
 from rulemsx.datapointsource import DataPointSource
 from rulemsx.rulecondition import RuleCondition
 
-def parseCommandLine():
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+def parseCommandLine(args=None):
     
     parser = argparse.ArgumentParser(description="Bloomberg - RMSX Example - RMSXSimpleStockHedgeDemo")
     
-    parser.add_argument('-p', '--percentage', help='The trigger threshold percentage of 30 Average Daily Volume', action='store', required=True)
-    parser.add_argument('-t', '--ticker', help='The hedge ticker to use', action='store', required=True)
-   
-    options = parser.parse_args()
+    parser.add_argument('-p', '--percentage', help='The trigger threshold percentage of 30 Average Daily Volume (the default for strategies in --config)', action='store', default=None)
+    parser.add_argument('-t', '--ticker', help='The hedge ticker to use (the default for strategies in --config)', action='store', default=None)
+    parser.add_argument('--config', help='JSON (or YAML, with PyYAML installed) file of hedge strategies and request templates, replacing the US and LN rules', action='store', default=None)
+    parser.add_argument('--refdata-ttl', help='Seconds a cached reference data value stays valid', action='store', type=float, default=3600.0)
+    parser.add_argument('--refdata-batch', help='Maximum number of securities per bulk reference data request', action='store', type=int, default=100)
+    parser.add_argument('--dispatch-workers', help='Number of threads sending EMSX requests (0 sends synchronously in the notification thread)', action='store', type=int, default=4)
+    parser.add_argument('--dispatch-queue', help='Maximum number of queued EMSX requests before rule actions block', action='store', type=int, default=1000)
+    parser.add_argument('--send-rate', help='Maximum EMSX requests sent per second (0 for no limit)', action='store', type=float, default=0)
+    parser.add_argument('--send-burst', help='Number of EMSX requests that may be sent at once before --send-rate applies', action='store', type=int, default=10)
+    parser.add_argument('--send-queue', help='Maximum number of EMSX requests waiting to be sent before new ones are dropped (0 for no limit)', action='store', type=int, default=10000)
+    parser.add_argument('--retry-attempts', help='Number of times an EMSX request is sent before giving up', action='store', type=int, default=3)
+    parser.add_argument('--retry-backoff', help='Seconds before the first retry of a failed EMSX request, doubled for every further retry', action='store', type=float, default=0.5)
+    parser.add_argument('--retry-codes', help='EMSX ERROR_CODE values that are retried (requests that raise are always retried)', action='store', type=int, nargs='*', default=[])
+    parser.add_argument('--hedge-window', help='Seconds to net fills before sending a hedge order (0 sends one hedge per fill)', action='store', type=float, default=1.0)
+    parser.add_argument('--hedge-max-qty', help='Send a netted hedge early once this many shares have been filled (0 for no limit)', action='store', type=float, default=0)
+    parser.add_argument('--hedge-ratio', help='Hedge shares per filled share', action='store', type=float, default=1.0)
+    parser.add_argument('--hedge-sizing', help='Hedge share for share, or by fill notional x beta / hedge price', action='store', choices=["shares", "beta"], default="shares")
+    parser.add_argument('--beta-field', help='Reference data field with the beta used by --hedge-sizing beta', action='store', default="EQY_BETA")
+    parser.add_argument('--price-field', help='Reference data field with the price used by --hedge-sizing beta', action='store', default="PX_LAST")
+    parser.add_argument('--market-data-refresh', help='Seconds between background refreshes of the beta and prices used by --hedge-sizing beta', action='store', type=float, default=300.0)
+    parser.add_argument('--retire-delay', help='Seconds to keep the dataset of a filled, cancelled or expired order or route before releasing it', action='store', type=float, default=30.0)
+    parser.add_argument('--memory-report', help='Seconds between memory footprint reports (0 to disable)', action='store', type=float, default=60.0)
+    parser.add_argument('--log-level', help='Minimum level to log', action='store', type=str.upper, choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO")
+    parser.add_argument('--log-file', help='File to append structured (JSON lines) log records to', action='store', default=None)
+    parser.add_argument('--no-console', help='Do not write log records to the console', action='store_true')
+    parser.add_argument('--templates', help='JSON file overriding the RouteBB, RouteBMTB and Hedge request templates', action='store', default=None)
+    parser.add_argument('--strategy-start', help='Start time for the RouteBMTB strategy', action='store', default=None)
+    parser.add_argument('--strategy-end', help='End time for the RouteBMTB strategy', action='store', default=None)
+    parser.add_argument('--strategy-max-volume', help='Maximum percentage of volume for the RouteBMTB strategy', action='store', default=None)
+    parser.add_argument('--latency', help='Record per-stage latency histograms from notification to EMSX response', action='store_true')
+    parser.add_argument('--latency-export', help='Seconds between latency snapshots (0 to disable)', action='store', type=float, default=60.0)
+    parser.add_argument('--latency-file', help='File the latest latency snapshot is written to as JSON', action='store', default=None)
+    parser.add_argument('--rule-engine', help='Evaluate rules by RuleMSX ruleset execution, or with the incremental dependency graph', action='store', choices=["rulemsx", "graph"], default="rulemsx")
+    parser.add_argument('--initial-paint-idle', help='Seconds without an initial paint notification after which the initial paint is taken to have ended', action='store', type=float, default=0.5)
+    parser.add_argument('--screen-initial-paint', help='Screen the initial paint orders in one batch and only build datasets for orders that can trigger a rule', action='store_true')
+    parser.add_argument('--lazy-datasets', help='Only build the dataset of an order or route once a change can trigger a rule, tracking the others by name (implies --screen-initial-paint)', action='store_true')
+    parser.add_argument('--snapshot', help='Warm start file of route fills seen, hedges sent and reference data, loaded at startup and appended to while running', action='store', default=None)
+    parser.add_argument('--shard', help=argparse.SUPPRESS, action='store', type=int, nargs=2, default=None)
+    parser.add_argument('--metrics-port', help='Serve live metrics in Prometheus text format on this port (0 to disable)', action='store', type=int, default=0)
+    parser.add_argument('--metrics-host', help='Address the metrics endpoint listens on', action='store', default="127.0.0.1")
+    parser.add_argument('--record', help='Record order, route and reference data notifications to a JSON lines file for RMSXSimpleStockHedgeReplay.py', action='store', default=None)
+   
+    options = parser.parse_args(args)
+    
+    if options.config is None and (options.percentage is None or options.ticker is None):
+        parser.error("-p/--percentage and -t/--ticker are required without --config")
+    
+    return options
+
+class AsyncLogger:
+    
+    # Callers only queue (time, level, message, args, fields); formatting and all
+    # console/file I/O happen on a background thread. Records below the configured
+    # level are dropped before any formatting.
+
+    def __init__(self, level=logging.INFO, console=True, path=None):
+        
+        self.level = level
+        self.console = console
+        self.file = None
+        self.queue = queue.SimpleQueue()
+        self.file_lock = threading.Lock()
+        if path is not None:
+            self.file = open(path, "a")
+        self.thread = threading.Thread(target=self.run, name="RMSXLogger", daemon=True)
+        self.thread.start()
+
+    def configure(self, level, console, path):
+        
+        self.level = level
+        self.console = console
+        if path is not None:
+            # The writer thread may be using the current file, so it is swapped under the lock
+            new_file = open(path, "a")
+            with self.file_lock:
+                old_file, self.file = self.file, new_file
+            if old_file is not None:
+                old_file.close()
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, msg, args, fields):
+        
+        if level < self.level:
+            return
+        self.queue.put((time.time(), level, msg, args, fields))
+
+    def run(self):
+        
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.write(record)
+            
+            # Write out whatever else is waiting before flushing
+            while True:
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    self.flush()
+                    return
+                self.write(record)
+            
+            self.flush()
+
+    def write(self, record):
+        
+        created, level, msg, args, fields = record
+        
+        try:
+            message = msg % args if args else msg
+        except (TypeError, ValueError):
+            message = msg + " " + repr(args)
+        
+        entry = {"time": created, "level": logging.getLevelName(level), "msg": message}
+        entry.update(fields)
+        
+        with self.file_lock:
+            if self.file is not None:
+                self.file.write(json.dumps(entry, default=str) + "\n")
+        
+        if self.console:
+            s = datetime.fromtimestamp(created).strftime("%Y%m%d%H%M%S%f")
+            if len(fields) > 0:
+                message = message + " " + " ".join(["%s=%s" % (k, v) for k, v in fields.items()])
+            print(s + "(RMSXSimpleStockHedgeDemo): \t" + message)
+
+    def flush(self):
+        
+        with self.file_lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def stop(self):
+        
+        self.queue.put(None)
+        self.thread.join()
+        with self.file_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+LOGGER = AsyncLogger()
+
+
+def log(msg, *args, level=logging.INFO, **fields):
+    
+    LOGGER.log(level, msg, args, fields)
+
+
+def to_number(value):
+    
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def to_int(value):
+    
+    number = to_number(value)
+    if number is None:
+        return None
+    return int(number)
+
+
+def resident_memory():
+    
+    # Current resident set size in bytes, or the peak where only that is available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    
+    return None
+
+
+def report_response(msg, success_text, failure_text):
+    
+    if msg is None:
+        # The request failed without a response, see RequestScheduler.send
+        log(failure_text, level=logging.ERROR)
+        return False
+    
+    if msg.messageType()=="ErrorInfo":
+        errorCode = msg.getElementAsInteger("ERROR_CODE")
+        errorMessage = msg.getElementAsString("ERROR_MESSAGE")
+        log(failure_text, level=logging.ERROR, error_code=errorCode, error_message=errorMessage)
+        return False
+    
+    log(success_text)
+    return True
+
+
+class LatencyHistogram:
+    
+    # Log-linear buckets in the style of HdrHistogram: values below 64 get their own
+    # bucket and every higher power of two is split into 32 linear buckets, so any
+    # nanosecond value is kept to ~3% precision in a few hundred sparse counters.
+
+    def __init__(self):
+        
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, value):
+        
+        if value < 0:
+            value = 0
+        bits = value.bit_length()
+        if bits <= 6:
+            index = value
+        else:
+            shift = bits - 6
+            index = shift * 32 + (value >> shift)
+        
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def value_at(self, index):
+        
+        if index < 64:
+            return index
+        shift = index // 32 - 1
+        low = (index % 32 + 32) << shift
+        return low + (1 << shift) // 2
+
+    def percentile(self, p):
+        
+        if self.count == 0:
+            return 0
+        
+        target = max(1, int(round(p / 100.0 * self.count)))
+        seen = 0
+        for index in sorted(self.counts.keys()):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self.value_at(index), self.max)
+        return self.max
+
+    def summary(self):
+        
+        # Microseconds
+        return {
+            "count": self.count,
+            "mean": self.total / 1000.0 / max(self.count, 1),
+            "p50": self.percentile(50) / 1000.0,
+            "p90": self.percentile(90) / 1000.0,
+            "p99": self.percentile(99) / 1000.0,
+            "max": self.max / 1000.0
+        }
+
+
+class LatencyTrace:
+    
+    # Monotonic timestamps (ns) of the last notification applied to a dataset
+    
+    __slots__ = ("received", "staled")
+    
+    def __init__(self):
+        self.received = time.perf_counter_ns()
+        self.staled = self.received
+
+
+class LatencyRecorder:
+    
+    # Histograms keyed by (stage, name), where name is a field, condition, rule/action
+    # or action class. Recording is a no-op unless enabled, so the hooks can stay in
+    # place. snapshot() returns the summaries; with an export interval they are also
+    # logged and written to path periodically.
+
+    def __init__(self, enabled, export_interval=0, path=None):
+        
+        self.enabled = enabled
+        self.path = path
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        
+        if enabled and export_interval > 0:
+            self.export_interval = export_interval
+            self.thread = threading.Thread(target=self.run, name="RMSXLatencyExport", daemon=True)
+            self.thread.start()
+
+    def record(self, stage, name, value):
+        
+        if not self.enabled:
+            return
+        
+        with self.lock:
+            histogram = self.histograms.get((stage, name))
+            if histogram is None:
+                histogram = self.histograms[(stage, name)] = LatencyHistogram()
+            histogram.record(value)
+
+    def since(self, stage, name, start):
+        
+        now = time.perf_counter_ns()
+        self.record(stage, name, now - start)
+        return now
+
+    def request(self, name, received, send, req):
+        
+        # Times an EMSX request relative to the notification that triggered it
+        if not self.enabled:
+            return send(req)
+        
+        sent = self.since("notify_to_send", name, received)
+        msg = send(req)
+        self.since("send_to_response", name, sent)
+        self.since("notify_to_response", name, received)
+        return msg
+
+    def snapshot(self):
+        
+        with self.lock:
+            items = [(key, histogram.summary()) for key, histogram in self.histograms.items()]
+        
+        result = {}
+        for (stage, name), summary in items:
+            result.setdefault(stage, {})[name] = summary
+        return result
+
+    def export(self):
+        
+        snapshot = self.snapshot()
+        for stage in sorted(snapshot.keys()):
+            for name, s in sorted(snapshot[stage].items()):
+                log("Latency %s %s: n=%d p50=%.1fus p90=%.1fus p99=%.1fus max=%.1fus", stage, name, s["count"], s["p50"], s["p90"], s["p99"], s["max"])
+        
+        if self.path is not None:
+            with open(self.path, "w") as f:
+                json.dump(snapshot, f, indent=1)
+
+    def run(self):
+        
+        while not self.stopping.wait(self.export_interval):
+            self.export()
+
+    def stop(self):
+        
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.enabled:
+            self.export()
+
+
+class RequestTemplate:
+    
+    # An EMSX request type with the fields that are the same for every request
+    # (broker, order type, TIF, strategy parameters), flattened once into a list of
+    # settings. build() only has to add the per-request fields. Blank strategy field
+    # values are sent with indicator 1 (not set), others with indicator 0.
+
+    def __init__(self, name, request_name, fields, strategy_name=None, strategy_fields=None):
+        
+        self.name = name
+        self.request_name = request_name
+        self.fields = tuple(fields.items())
+        self.strategy_name = strategy_name
+        self.strategy_fields = tuple([(value, 1 if value == "" else 0) for value in (strategy_fields or [])])
+
+    @classmethod
+    def from_config(cls, name, config):
+        
+        strategy = config.get("strategy")
+        if strategy is None:
+            return cls(name, config["request"], config.get("fields", {}))
+        
+        # Strategy fields are given in order, either as plain values or as {"name": ..., "value": ...}
+        values = []
+        for field in strategy.get("fields", []):
+            if isinstance(field, dict):
+                values.append(str(field.get("value", "")))
+            else:
+                values.append(str(field))
+        return cls(name, config["request"], config.get("fields", {}), strategy["name"], values)
+
+    def with_strategy_fields(self, overrides):
+        
+        # overrides maps field positions to new values
+        values = [value for value, indicator in self.strategy_fields]
+        for position, value in overrides.items():
+            if value is not None:
+                if self.strategy_name is None or position >= len(values):
+                    raise ValueError("Template %s has no strategy field %d to set to %s" % (self.name, position + 1, value))
+                values[position] = value
+        return RequestTemplate(self.name, self.request_name, dict(self.fields), self.strategy_name, values)
+
+    def with_fields(self, overrides, name=None):
+        
+        # overrides maps EMSX field names (e.g. EMSX_BROKER) to new values
+        fields = dict(self.fields)
+        fields.update(overrides)
+        return RequestTemplate(name or self.name, self.request_name, fields, self.strategy_name, [value for value, indicator in self.strategy_fields])
+
+    def build(self, easymsx, values):
+        
+        req = easymsx.create_request(self.request_name)
+        
+        for name, value in self.fields:
+            req.set(name, value)
+        for name, value in values:
+            req.set(name, value)
+        
+        if self.strategy_name is not None:
+            strategy = req.getElement("EMSX_STRATEGY_PARAMS")
+            strategy.setElement("EMSX_STRATEGY_NAME", self.strategy_name)
+            
+            indicator = strategy.getElement("EMSX_STRATEGY_FIELD_INDICATORS")
+            data = strategy.getElement("EMSX_STRATEGY_FIELDS")
+            
+            for value, flag in self.strategy_fields:
+                data.appendElement().setElement("EMSX_FIELD_DATA", value)
+                indicator.appendElement().setElement("EMSX_FIELD_INDICATOR", flag)
+        
+        return req
+
+
+DEFAULT_TEMPLATES = {
+    "RouteBB": {
+        "request": "RouteEx",
+        "fields": {"EMSX_BROKER": "BB", "EMSX_HAND_INSTRUCTION": "ANY", "EMSX_ORDER_TYPE": "MKT", "EMSX_TIF": "DAY"}
+    },
+    "RouteBMTB": {
+        "request": "RouteEx",
+        "fields": {"EMSX_BROKER": "BMTB", "EMSX_HAND_INSTRUCTION": "ANY", "EMSX_ORDER_TYPE": "MKT", "EMSX_TIF": "DAY"},
+        "strategy": {
+            "name": "VWAP",
+            "fields": [
+                {"name": "StartTime", "value": "09:30:00"},
+                {"name": "EndTime", "value": "10:30:00"},
+                {"name": "Max%Volume", "value": ""},
+                {"name": "%AMSession", "value": ""},
+                {"name": "OPG", "value": ""},
+                {"name": "MOC", "value": ""},
+                {"name": "CompletePX", "value": ""},
+                {"name": "TriggerPX", "value": ""},
+                {"name": "DarkComplete", "value": ""},
+                {"name": "DarkCompPX", "value": ""},
+                {"name": "RefIndex", "value": ""},
+                {"name": "Discretion", "value": ""}
+            ]
+        }
+    },
+    "Hedge": {
+        "request": "CreateOrderAndRouteEx",
+        "fields": {"EMSX_ORDER_TYPE": "MKT", "EMSX_TIF": "DAY", "EMSX_HAND_INSTRUCTION": "ANY", "EMSX_BROKER": "EFIX"}
+    }
+}
+
+
+def load_templates(options, overrides=None):
+    
+    # overrides are the templates given in --config, applied over --templates
+    config = dict(DEFAULT_TEMPLATES)
+    if options.templates is not None:
+        with open(options.templates) as f:
+            config.update(json.load(f))
+    if overrides is not None:
+        config.update(overrides)
+    
+    templates = {}
+    for name, template_config in config.items():
+        templates[name] = RequestTemplate.from_config(name, template_config)
+    
+    # StartTime, EndTime and Max%Volume are the first three VWAP strategy fields
+    try:
+        templates["RouteBMTB"] = templates["RouteBMTB"].with_strategy_fields({0: options.strategy_start, 1: options.strategy_end, 2: options.strategy_max_volume})
+    except ValueError as e:
+        raise ValueError("%s: --strategy-start, --strategy-end and --strategy-max-volume need a RouteBMTB template with at least 3 strategy fields" % e)
+    
+    return templates
+
+
+# The rules the demo runs without --config; -p and -t give the percentage and hedge ticker
+DEFAULT_STRATEGIES = [
+    {"name": "US", "exchanges": ["US"], "route": "RouteBB", "hedge": {"template": "Hedge"}},
+    {"name": "LN", "exchanges": ["LN"], "route": "RouteBMTB"}
+]
+
+
+class HedgeStrategy:
+    
+    # One entry of the strategy config. The orders it covers are given by exchange
+    # codes and/or fnmatch ticker patterns (every order if neither is given). New
+    # orders below percentage x 20 day average volume are routed with the route
+    # template, and fills on their routes are hedged in the hedge ticker; either the
+    # route or the hedge may be left out. As in the original rules, new orders are
+    # matched on the EXCH_CODE reference data and fills on the order's EMSX_EXCHANGE.
+    # Where strategies overlap, the first one in the config wins: an order is routed
+    # by the first strategy with a route that covers it, and its fills are hedged by
+    # the first one with a hedge.
+
+    def __init__(self, name, exchanges, tickers, percentage, route, hedge_ticker, hedge_template):
+        
+        self.name = name
+        self.exchanges = tuple(exchanges or [])
+        self.tickers = tuple(tickers or [])
+        self.ticker_pattern = None
+        if len(self.tickers) > 0:
+            self.ticker_pattern = re.compile("|".join([fnmatch.translate(pattern) for pattern in self.tickers]))
+        self.percentage = to_number(percentage)
+        self.route = route
+        self.hedge_ticker = hedge_ticker
+        self.hedge_template = hedge_template
+
+    @classmethod
+    def from_config(cls, config, templates, percentage, ticker):
+        
+        # percentage and ticker are the defaults from -p and -t
+        name = config["name"]
+        route = None
+        if config.get("route") is not None:
+            route = cls.template(name, config["route"], templates)
+            percentage = config.get("percentage", percentage)
+            if to_number(percentage) is None:
+                raise ValueError("Strategy %s routes orders but has no percentage" % name)
+        
+        hedge = config.get("hedge")
+        hedge_ticker = hedge_template = None
+        if hedge is not None:
+            hedge_ticker = hedge.get("ticker", ticker)
+            if hedge_ticker is None:
+                raise ValueError("Strategy %s hedges fills but has no hedge ticker" % name)
+            hedge_template = cls.template(name, hedge.get("template", "Hedge"), templates)
+        
+        return cls(name, config.get("exchanges"), config.get("tickers"), percentage, route, hedge_ticker, hedge_template)
+
+    @staticmethod
+    def template(name, config, templates):
+        
+        # A template name, or {"template": name, "fields": {...}} to change fields such as
+        # EMSX_BROKER; a changed template is named <template>@<strategy>, as hedges are
+        # only netted with others sent with the same template
+        fields = None
+        if isinstance(config, dict):
+            fields = config.get("fields")
+            config = config["template"]
+        if not config in templates:
+            raise ValueError("Strategy %s uses unknown template %s" % (name, config))
+        if fields:
+            return templates[config].with_fields(fields, "%s@%s" % (config, name))
+        return templates[config]
+
+    def matches_exchange(self, exchange):
+        return len(self.exchanges) == 0 or exchange in self.exchanges
+
+    def matches_ticker(self, ticker):
+        return self.ticker_pattern is None or (ticker is not None and self.ticker_pattern.match(ticker) is not None)
+
+    def matches(self, exchange, ticker):
+        return self.matches_exchange(exchange) and self.matches_ticker(ticker)
+
+    def disjoint(self, other):
+        
+        # True if no order can be covered by both strategies
+        return len(self.exchanges) > 0 and len(other.exchanges) > 0 and len(set(self.exchanges) & set(other.exchanges)) == 0
+
+
+def load_config(path):
+    
+    with open(path) as f:
+        if os.path.splitext(path)[1].lower() in (".yaml", ".yml"):
+            if yaml is None:
+                raise ValueError("PyYAML is needed to read " + path)
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def load_strategies(options):
+    
+    # The strategies from --config, or DEFAULT_STRATEGIES, and the request templates
+    # they use. The config is {"templates": {...}, "strategies": [...]}, with
+    # templates in the --templates format.
+    config = {"strategies": DEFAULT_STRATEGIES}
+    if options.config is not None:
+        config = load_config(options.config)
+    
+    templates = load_templates(options, config.get("templates"))
+    strategies = [HedgeStrategy.from_config(strategy, templates, options.percentage, options.ticker) for strategy in config.get("strategies", [])]
+    
+    names = [strategy.name for strategy in strategies]
+    if len(set(names)) != len(names):
+        raise ValueError("Strategy names must be unique: " + ", ".join(names))
+    
+    return templates, strategies
+
+
+class DemoRuleEvaluator(RuleEvaluator):
+    
+    # Remembers the dependent datapoint names so evaluators can be wrapped or analysed.
+    # COST is the relative cost of one evaluation, used to order a rule's conditions.
+    
+    COST = 1
+    
+    def add_dependent_datapoint_name(self, datapoint_name):
+        
+        if getattr(self, "dependent_names", None) is None:
+            self.dependent_names = []
+        self.dependent_names.append(datapoint_name)
+        super().add_dependent_datapoint_name(datapoint_name)
+
+
+def notification_event(notification, field_names, key_names):
+
+    # A notification as a plain dict: all field_names, or for an update only the
+    # key fields and the changed fields
+    source = notification.source
+    if notification.type == EasyMSXNotification.NotificationType.UPDATE:
+        fields = {name: source.field(name).value() for name in key_names}
+        for fc in notification.field_changes:
+            fields[fc.field.name()] = fc.new_value
+    else:
+        fields = {name: source.field(name).value() for name in field_names}
+
+    return {"category": notification.category.name, "type": notification.type.name, "fields": fields}
+
+
+class NotificationRecorder:
+    
+    # Writes the order/route notifications and reference data seen by the demo as
+    # JSON lines: {"t": seconds since start, "category": ..., "type": ..., "fields": {...}}.
+    # For updates only the key fields and the changed fields are written.
+
+    def __init__(self, path):
+        
+        self.file = open(path, "w")
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+
+    def write(self, event):
+        
+        event["t"] = round(time.monotonic() - self.started, 6)
+        line = json.dumps(event)
+        with self.lock:
+            self.file.write(line + "\n")
+
+    def record(self, notification, field_names, key_names):
+        self.write(notification_event(notification, field_names, key_names))
+
+    def record_refdata(self, ticker, field, value):
+        self.write({"category": "REFDATA", "ticker": ticker, "fields": {field: value}})
+
+    def stop(self):
+        with self.lock:
+            self.file.close()
+
+
+class RefDataCache:
+    
+    # Reference data values keyed by (ticker, field). Values are fetched in bulk
+    # multi-security requests and reused until they are older than the TTL. A
+    # lookup that misses fetches every field asked for so far that the security is
+    # missing, so a new security costs one request rather than one per field.
+    # generation changes whenever values are stored, so values worked out from the
+    # cache can tell when to work them out again.
+
+    def __init__(self, easymkt, ttl=3600.0, batch_size=100, recorder=None, snapshot=None):
+        
+        self.easymkt = easymkt
+        self.recorder = recorder
+        self.snapshot = snapshot
+        self.ttl = ttl
+        self.batch_size = max(1, batch_size)
+        self.values = {}
+        self.fields = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0
+        self.generation = 0
+
+    def is_fresh(self, entry, now):
+        return entry is not None and (now - entry[1]) < self.ttl
+
+    def restore(self, values):
+        
+        # values maps (ticker, field) to (value, wall clock fetch time), as kept by WarmStartSnapshot
+        now = time.monotonic()
+        wall = time.time()
+        with self.lock:
+            for key, (value, fetched) in values.items():
+                self.values[key] = (value, now - (wall - fetched))
+            self.generation += 1
+
+    def get(self, ticker, field):
+        
+        now = time.monotonic()
+        entry = self.values.get((ticker, field))
+        if self.is_fresh(entry, now):
+            self.hits += 1
+            return entry[0]
+        
+        self.misses += 1
+        with self.lock:
+            self.fields[field] = True
+            fields = list(self.fields)
+        self.fetch([ticker], [f for f in fields if not self.is_fresh(self.values.get((ticker, f)), now)])
+        entry = self.values.get((ticker, field))
+        return None if entry is None else entry[0]
+
+    def expiry(self, ticker, field):
+        
+        # When the cached value stops being fresh (monotonic time, 0 if not cached)
+        entry = self.values.get((ticker, field))
+        return 0.0 if entry is None else entry[1] + self.ttl
+
+    def peek(self, ticker, field):
+        
+        # The cached value, however old, without ever sending a request
+        entry = self.values.get((ticker, field))
+        return None if entry is None else entry[0]
+
+    def prefetch(self, tickers, fields):
+        
+        # Only request the securities that have at least one missing or expired field
+        with self.lock:
+            self.fields.update(dict.fromkeys(fields, True))
+        now = time.monotonic()
+        wanted = []
+        for ticker in dict.fromkeys(tickers):
+            for field in fields:
+                if not self.is_fresh(self.values.get((ticker, field)), now):
+                    wanted.append(ticker)
+                    break
+        
+        if len(wanted) > 0:
+            log("Prefetching %s for %d securities", ",".join(fields), len(wanted))
+            self.fetch(wanted, fields)
+
+    def fetch(self, tickers, fields):
+        
+        for i in range(0, len(tickers), self.batch_size):
+            chunk = tickers[i:i + self.batch_size]
+            
+            req = self.easymkt.create_request("ReferenceDataRequest")
+            for ticker in chunk:
+                req.append("securities", ticker)
+            for field in fields:
+                req.append("fields", field)
+
+            msg = self.easymkt.send_request(req)
+            self.requests += 1
+            
+            self.store(msg, chunk, fields)
+
+    def store(self, msg, tickers, fields):
+        
+        now = time.monotonic()
+        received = {}
+        
+        security_data = msg.getElement("securityData")
+        for i in range(security_data.numValues()):
+            sd = security_data.getValue(i)
+            ticker = sd.getElementAsString("security")
+            field_data = sd.getElement("fieldData")
+            for field in fields:
+                if field_data.hasElement(field):
+                    received[(ticker, field)] = (field_data.getElement(field).getValue(), now)
+                else:
+                    received[(ticker, field)] = (None, now)
+        
+        # Securities missing from the response are cached as None so they are not re-requested every call
+        for ticker in tickers:
+            for field in fields:
+                if not (ticker, field) in received:
+                    received[(ticker, field)] = (None, now)
+        
+        with self.lock:
+            self.values.update(received)
+            self.generation += 1
+        
+        if self.recorder is not None:
+            for (ticker, field), (value, fetched) in received.items():
+                self.recorder.record_refdata(ticker, field, value)
+        
+        if self.snapshot is not None:
+            self.snapshot.record_refdata(received)
+
+
+class HedgeSizer:
+    
+    # Sizes hedges by notional and beta: fill quantity x price x beta / hedge price.
+    # Beta and prices are only read from the RefDataCache here. A background thread
+    # fetches securities in bulk as soon as they are tracked, then refetches all
+    # tracked securities every refresh seconds, so sizing never waits for a request.
+    # A fill whose beta or prices are not known yet is hedged share for share.
+
+    def __init__(self, refdata, beta_field, price_field, refresh):
+        
+        self.refdata = refdata
+        self.beta_field = beta_field
+        self.price_field = price_field
+        self.fields = [beta_field, price_field]
+        self.refresh = refresh
+        self.tracked = set()
+        self.new = set()
+        self.lock = threading.Lock()
+        self.sized = 0
+        self.fallbacks = 0
+        self.wake = threading.Event()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name="RMSXHedgeSizer", daemon=True)
+        self.thread.start()
+
+    def track(self, tickers):
+        
+        with self.lock:
+            new = [ticker for ticker in tickers if not ticker in self.tracked]
+            self.tracked.update(new)
+            self.new.update(new)
+        if len(new) > 0:
+            self.wake.set()
+
+    def size(self, ticker, hedge_ticker, quantity):
+        
+        price = to_number(self.refdata.peek(ticker, self.price_field))
+        beta = to_number(self.refdata.peek(ticker, self.beta_field))
+        hedge_price = to_number(self.refdata.peek(hedge_ticker, self.price_field))
+        
+        if price is None or beta is None or hedge_price is None or hedge_price <= 0:
+            self.fallbacks += 1
+            self.track([ticker, hedge_ticker])
+            log("No beta/price for %s or %s yet - hedging %s shares one for one", ticker, hedge_ticker, quantity, level=logging.WARNING)
+            return quantity
+        
+        self.sized += 1
+        return quantity * price * beta / hedge_price
+
+    def run(self):
+        
+        refreshed = time.monotonic()
+        while not self.stopping:
+            self.wake.wait(max(0, refreshed + self.refresh - time.monotonic()))
+            self.wake.clear()
+            if self.stopping:
+                break
+            
+            with self.lock:
+                refreshing = time.monotonic() - refreshed >= self.refresh
+                if refreshing:
+                    tickers = list(self.tracked)
+                    refreshed = time.monotonic()
+                else:
+                    tickers = list(self.new)
+                self.new.clear()
+            
+            if len(tickers) > 0:
+                try:
+                    if refreshing:
+                        self.refdata.fetch(tickers, self.fields)
+                    else:
+                        # New securities usually came in with the orders' reference data
+                        self.refdata.prefetch(tickers, self.fields)
+                except Exception as e:
+                    log("Market data refresh for %d securities failed: %s", len(tickers), e, level=logging.ERROR)
+
+    def stop(self):
+        
+        self.stopping = True
+        self.wake.set()
+        self.thread.join()
+        log("Hedge sizing: %d fills sized by beta, %d hedged one for one", self.sized, self.fallbacks)
+
+
+class WarmStartSnapshot:
+    
+    # An append-only file of binary records, each a (kind, payload length) header and
+    # a payload: the last filled quantity seen per route when its fill was handed to
+    # hedging, fill quantities hedged per order once the hedge order was accepted, and
+    # reference data with its fetch time. It is read through mmap at startup, where a
+    # torn last record is ignored, and rewritten compacted before appending resumes.
+    # Fills seen but not hedged before the restart are left in unhedged. Reference
+    # data is only appended when its value changed, and the file is rewritten
+    # compacted again once the appended records outnumber what it would keep.
+    #
+    # A shard's snapshot starts with a (shard, shards) record. Orders are spread over
+    # the shards by sequence number, so a snapshot only holds the fills of its own
+    # orders for the same number of shards; any other shard or count is refused.
+
+    HEADER = struct.Struct("<BI")
+    ROUTE = struct.Struct("<qqq")
+    HEDGE = struct.Struct("<qq")
+    SHARD = struct.Struct("<II")
+    ROUTE_FILLED = 1
+    HEDGED = 2
+    REFDATA = 3
+    SHARDED = 4
+    COMPACT_MIN = 10000
+
+    def __init__(self, path, shard=None):
+        
+        # shard is (shard, shards) when run by RMSXSimpleStockHedgeShards.py
+        self.path = path
+        self.shard = None if shard is None else tuple(shard)
+        self.loaded_shard = None
+        self.routes = {}
+        self.hedged = {}
+        self.refdata = {}
+        self.lock = threading.Lock()
+        self.records = 0
+        self.kept = 0
+        self.appended = 0
+        
+        self.load()
+        if self.records > 0 and self.loaded_shard != self.shard:
+            raise ValueError("Snapshot %s was written %s but is being opened %s - use a new snapshot file" % (path, self.describe(self.loaded_shard), self.describe(self.shard)))
+        
+        seen = {}
+        for (ord_no, route_id), filled in self.routes.items():
+            seen[ord_no] = seen.get(ord_no, 0) + filled
+        self.unhedged = {ord_no: filled - self.hedged.get(ord_no, 0) for ord_no, filled in seen.items() if filled > self.hedged.get(ord_no, 0)}
+        
+        self.compact()
+        self.file = open(path, "ab")
+        log("Snapshot %s: %d records read, %d kept - %d routes, %d orders hedged, %d orders with unhedged fills, %d reference data values", self.path, self.records, self.kept, len(self.routes), len(self.hedged), len(self.unhedged), len(self.refdata))
+
+    def load(self):
+        
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+        
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offset = 0
+                while offset + self.HEADER.size <= size:
+                    kind, length = self.HEADER.unpack_from(data, offset)
+                    start = offset + self.HEADER.size
+                    if start + length > size:
+                        break
+                    self.apply(kind, data, start, length)
+                    self.records += 1
+                    offset = start + length
+        
+        if offset < size:
+            log("Snapshot %s: ignoring %d bytes of an incomplete last record", self.path, size - offset, level=logging.WARNING)
+
+    def apply(self, kind, data, start, length):
+        
+        if kind == self.ROUTE_FILLED:
+            ord_no, route_id, filled = self.ROUTE.unpack_from(data, start)
+            self.routes[(ord_no, route_id)] = filled
+        elif kind == self.HEDGED:
+            ord_no, quantity = self.HEDGE.unpack_from(data, start)
+            self.hedged[ord_no] = self.hedged.get(ord_no, 0) + quantity
+        elif kind == self.REFDATA:
+            ticker, field, value, fetched = json.loads(data[start:start + length].decode("utf-8"))
+            self.refdata[(ticker, field)] = (value, fetched)
+        elif kind == self.SHARDED:
+            self.loaded_shard = self.SHARD.unpack_from(data, start)
+
+    @classmethod
+    def written_by(cls, path):
+        
+        # The (shard, shards) a snapshot file was written by, None without shards,
+        # or False if there is no snapshot file; only the first record is read
+        try:
+            with open(path, "rb") as f:
+                header = f.read(cls.HEADER.size + cls.SHARD.size)
+        except FileNotFoundError:
+            return False
+        if len(header) < cls.HEADER.size:
+            return False
+        kind, length = cls.HEADER.unpack_from(header, 0)
+        if kind != cls.SHARDED or len(header) < cls.HEADER.size + cls.SHARD.size:
+            return None
+        return cls.SHARD.unpack_from(header, cls.HEADER.size)
+
+    @staticmethod
+    def describe(shard):
+        if shard is None:
+            return "without shards"
+        return "by shard %d of %d" % shard
+
+    def encode(self, kind, payload):
+        return self.HEADER.pack(kind, len(payload)) + payload
+
+    def encode_refdata(self, ticker, field, value, fetched):
+        return self.encode(self.REFDATA, json.dumps([ticker, field, value, fetched], default=str).encode("utf-8"))
+
+    def compact(self):
+        
+        records = []
+        if self.shard is not None:
+            records.append(self.encode(self.SHARDED, self.SHARD.pack(*self.shard)))
+        for (ord_no, route_id), filled in self.routes.items():
+            records.append(self.encode(self.ROUTE_FILLED, self.ROUTE.pack(ord_no, route_id, filled)))
+        for ord_no, quantity in self.hedged.items():
+            records.append(self.encode(self.HEDGED, self.HEDGE.pack(ord_no, quantity)))
+        for (ticker, field), (value, fetched) in self.refdata.items():
+            records.append(self.encode_refdata(ticker, field, value, fetched))
+        
+        with open(self.path + ".tmp", "wb") as f:
+            f.write(b"".join(records))
+        os.replace(self.path + ".tmp", self.path)
+        self.kept = len(records)
+        self.appended = 0
+
+    def last_filled(self, ord_no, route_id):
+        return self.routes.get((ord_no, route_id))
+
+    def append(self, records):
+        
+        # Called with the lock held. Flushed per write so that the records survive the
+        # process, not the machine.
+        self.file.write(b"".join(records))
+        self.file.flush()
+        self.appended += len(records)
+        if self.appended >= max(self.COMPACT_MIN, 2 * self.kept):
+            self.file.close()
+            self.compact()
+            self.file = open(self.path, "ab")
+            log("Snapshot %s: rewritten with %d records", self.path, self.kept, level=logging.DEBUG)
+
+    def record_route_filled(self, ord_no, route_id, filled):
+        
+        with self.lock:
+            self.routes[(ord_no, route_id)] = filled
+            self.append([self.encode(self.ROUTE_FILLED, self.ROUTE.pack(ord_no, route_id, filled))])
+
+    def record_hedged(self, orders):
+        
+        # orders maps order numbers to the fill quantity that was hedged
+        with self.lock:
+            for ord_no, quantity in orders.items():
+                self.hedged[ord_no] = self.hedged.get(ord_no, 0) + quantity
+            self.append([self.encode(self.HEDGED, self.HEDGE.pack(ord_no, quantity)) for ord_no, quantity in orders.items()])
+
+    def record_refdata(self, values):
+        
+        # An unchanged value only has its fetch time updated for the next rewrite
+        wall = time.time()
+        now = time.monotonic()
+        with self.lock:
+            records = []
+            for key, (value, fetched) in values.items():
+                previous = self.refdata.get(key)
+                self.refdata[key] = (value, wall - (now - fetched))
+                if previous is None or previous[0] != value:
+                    records.append(self.encode_refdata(key[0], key[1], value, self.refdata[key][1]))
+            if len(records) > 0:
+                self.append(records)
+
+    def stop(self):
+        
+        with self.lock:
+            self.file.close()
+
+
+class InitialPaintScreen:
+    
+    # Evaluates the NewOrder<strategy> conditions (status NEW, not a hedge, amount
+    # below the percentage x 20 day average volume of the first strategy covering
+    # its exchange and ticker) for a whole blotter at once, on columns of order fields
+    # and cached reference data. With NumPy the conditions are vector expressions;
+    # without it the same test runs per order.
+
+    def __init__(self, refdata, strategies):
+        
+        self.refdata = refdata
+        self.strategies = [strategy for strategy in strategies if strategy.route is not None]
+
+    def screen(self, orders):
+        
+        # One flag per order: True if the order rules would fire on it now
+        if len(self.strategies) == 0 or len(orders) == 0:
+            return [False] * len(orders)
+        
+        tickers = [o.field("EMSX_TICKER").value() for o in orders]
+        amount = [to_int(o.field("EMSX_AMOUNT").value()) for o in orders]
+        status = [o.field("EMSX_STATUS").value() for o in orders]
+        notes = [o.field("EMSX_NOTES").value() for o in orders]
+        exchange = [self.refdata.get(ticker, "EXCH_CODE") for ticker in tickers]
+        avg_vol = [to_number(self.refdata.get(ticker, "VOLUME_AVG_20D")) for ticker in tickers]
+        
+        if numpy is None:
+            return [s == "NEW" and (n is None or not n.startswith("HEDGE")) and a is not None and v is not None
+                    and self.below(a, v, e, t)
+                    for t, a, s, n, e, v in zip(tickers, amount, status, notes, exchange, avg_vol)]
+        
+        amount = numpy.array(amount, dtype=float)
+        avg_vol = numpy.array(avg_vol, dtype=float)
+        exchange = numpy.array(exchange, dtype=object)
+        hedge = numpy.char.startswith(numpy.array([n or "" for n in notes], dtype=str), "HEDGE")
+        
+        triggers = numpy.zeros(len(orders), dtype=bool)
+        covered = numpy.zeros(len(orders), dtype=bool)
+        for strategy in self.strategies:
+            matched = ~covered
+            if len(strategy.exchanges) > 0:
+                on_exchange = numpy.zeros(len(orders), dtype=bool)
+                for code in strategy.exchanges:
+                    on_exchange |= exchange == code
+                matched &= on_exchange
+            if strategy.ticker_pattern is not None:
+                matched &= numpy.array([strategy.matches_ticker(t) for t in tickers], dtype=bool)
+            # Missing amounts and volumes are NaN, which compares False like the evaluator's None check
+            with numpy.errstate(invalid="ignore"):
+                triggers |= matched & (amount < strategy.percentage * avg_vol)
+            covered |= matched
+        
+        return ((numpy.array(status, dtype=object) == "NEW") & ~hedge & triggers).tolist()
+
+    def below(self, amount, avg_vol, exchange, ticker):
+        
+        for strategy in self.strategies:
+            if strategy.matches(exchange, ticker):
+                return amount < strategy.percentage * avg_vol
+        return False
+
+
+class SynchronousDispatcher:
+    
+    # Runs each job immediately in the calling thread.
+    
+    def submit(self, key, job):
+        job()
+
+    def shutdown(self):
+        pass
+
+
+class ThreadPoolDispatcher:
+    
+    # Runs jobs on a bounded thread pool. Jobs that share a key (the order sequence
+    # number) run one at a time in submission order; jobs with different keys run
+    # in parallel. Once max_pending jobs are waiting, submit() blocks the caller.
+
+    def __init__(self, workers, max_pending):
+        
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="RMSXDispatch")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def submit(self, key, job):
+        
+        self.slots.acquire()
+        
+        with self.lock:
+            queue = self.queues.get(key)
+            if queue is not None:
+                # A job for this key is already running; it will pick this one up when done
+                queue.append(job)
+                return
+            self.queues[key] = deque()
+        
+        self.executor.submit(self.run, key, job)
+
+    def run(self, key, job):
+        
+        while job is not None:
+            try:
+                job()
+            except Exception as e:
+                log("Dispatch of job for %s failed: %s", key, e, level=logging.ERROR)
+            
+            with self.lock:
+                self.slots.release()
+                queue = self.queues[key]
+                if len(queue) > 0:
+                    job = queue.popleft()
+                else:
+                    del self.queues[key]
+                    job = None
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class ScheduledRequest(abc.ABC):
+    
+    # An EMSX request waiting in the RequestScheduler. The request is only built
+    # when it is first sent. Requests sharing a key are dispatched in order. Lower
+    # priorities are sent first.
+
+    PRIORITY = 1
+    coalesce_key = None
+
+    def __init__(self, name, key, received):
+        
+        self.name = name
+        self.key = key
+        self.received = received
+        self.attempts = 0
+        self.req = None
+
+    @abc.abstractmethod
+    def build(self, easymsx):
+        pass
+
+    @abc.abstractmethod
+    def completed(self, msg):
+        
+        # Called once with the final response, or None if the last attempt raised
+        pass
+
+
+class CoalescingRequest(ScheduledRequest):
+    
+    # A request that, while it waits, absorbs later ones with the same coalesce_key
+    # through merge(); it is only built when it is first sent, so it goes out with
+    # everything it absorbed.
+
+    def __init__(self, name, key, received, coalesce_key):
+        
+        super().__init__(name, key, received)
+        self.coalesce_key = coalesce_key
+
+    @abc.abstractmethod
+    def merge(self, other):
+        pass
+
+
+class RequestScheduler:
+    
+    # Sends queued requests in priority order through the dispatcher, at most rate
+    # per second on average (a token bucket holding up to burst requests; rate 0 is
+    # no limit). A request that raises, or is answered with an ERROR_CODE in
+    # retry_codes, is queued again after backoff seconds, doubling per attempt, until
+    # max_attempts sends have failed. Once max_queued requests are waiting, new ones
+    # are dropped.
+
+    def __init__(self, easymsx, dispatcher, latency, rate, burst, max_queued, max_attempts, backoff, retry_codes):
+        
+        self.easymsx = easymsx
+        self.dispatcher = dispatcher
+        self.latency = latency
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_queued = max_queued
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.retry_codes = frozenset(retry_codes)
+        self.ready = []
+        self.delayed = []
+        self.coalescing = {}
+        self.sequence = itertools.count()
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.stopping = False
+        self.submitted = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.outcomes = {}
+        self.thread = threading.Thread(target=self.run, name="RMSXRequestScheduler", daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        
+        with self.condition:
+            self.submitted += 1
+            
+            if request.coalesce_key is not None:
+                queued = self.coalescing.get(request.coalesce_key)
+                if queued is not None:
+                    queued.merge(request)
+                    self.coalesced += 1
+                    return
+            
+            if self.max_queued > 0 and len(self.ready) >= self.max_queued:
+                self.dropped += 1
+                log("Send queue full (%d requests) - %s for %s dropped", len(self.ready), request.name, request.key, level=logging.ERROR)
+                return
+            
+            if request.coalesce_key is not None:
+                self.coalescing[request.coalesce_key] = request
+            heapq.heappush(self.ready, (request.PRIORITY, next(self.sequence), request))
+            self.condition.notify()
+
+    def take_token(self, now):
+        
+        # 0 if a token was taken, otherwise the seconds until the next one
+        if self.rate <= 0:
+            return 0
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def next_request(self):
+        
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                while len(self.delayed) > 0 and self.delayed[0][0] <= now:
+                    due, sequence, request = heapq.heappop(self.delayed)
+                    heapq.heappush(self.ready, (request.PRIORITY, sequence, request))
+                
+                timeout = None
+                if len(self.ready) > 0:
+                    timeout = self.take_token(now)
+                    if timeout == 0:
+                        request = heapq.heappop(self.ready)[2]
+                        if request.coalesce_key is not None and self.coalescing.get(request.coalesce_key) is request:
+                            del self.coalescing[request.coalesce_key]
+                        self.in_flight += 1
+                        return request
+                elif self.stopping and len(self.delayed) == 0 and self.in_flight == 0:
+                    return None
+                
+                if len(self.delayed) > 0:
+                    retry = self.delayed[0][0] - now
+                    timeout = retry if timeout is None else min(timeout, retry)
+                self.condition.wait(timeout)
+
+    def run(self):
+        
+        while True:
+            request = self.next_request()
+            if request is None:
+                break
+            self.dispatcher.submit(request.key, lambda request=request: self.send(request))
+
+    def send(self, request):
+        
+        # Unless the request is queued again, completed() is called whatever happens,
+        # so requests such as hedges can settle their accounting
+        msg = None
+        retrying = False
+        try:
+            try:
+                if request.req is None:
+                    request.req = request.build(self.easymsx)
+                request.attempts += 1
+                msg = self.latency.request(request.name, request.received, self.easymsx.send_request, request.req)
+                if msg.messageType() == "ErrorInfo" and msg.getElementAsInteger("ERROR_CODE") in self.retry_codes:
+                    error = msg.getElementAsString("ERROR_MESSAGE")
+                else:
+                    error = None
+            except Exception as e:
+                msg = None
+                error = str(e)
+            
+            with self.condition:
+                self.in_flight -= 1
+                self.sent += 1
+                
+                if error is not None and request.attempts < self.max_attempts:
+                    delay = self.backoff * 2 ** (request.attempts - 1)
+                    self.retried += 1
+                    heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.sequence), request))
+                    log("%s for %s failed (attempt %d): %s - retrying in %.2fs", request.name, request.key, request.attempts, error, delay, level=logging.WARNING)
+                    self.condition.notify()
+                    retrying = True
+                    return
+                
+                if error is not None:
+                    self.failed += 1
+                    outcome = "failed"
+                elif msg.messageType() == "ErrorInfo":
+                    outcome = "rejected"
+                else:
+                    outcome = "accepted"
+                self.outcomes[(request.name, outcome)] = self.outcomes.get((request.name, outcome), 0) + 1
+                self.condition.notify()
+            
+            if error is not None and msg is None:
+                log("%s for %s failed after %d attempts: %s", request.name, request.key, request.attempts, error, level=logging.ERROR)
+        finally:
+            if not retrying:
+                request.completed(msg)
+
+    def stats(self):
+        
+        with self.condition:
+            return {"queued": len(self.ready), "retrying": len(self.delayed), "in_flight": self.in_flight, "submitted": self.submitted,
+                    "coalesced": self.coalesced, "dropped": self.dropped, "sent": self.sent, "retried": self.retried, "failed": self.failed,
+                    "outcomes": dict(self.outcomes)}
+
+    def stop(self):
+        
+        # Sends everything still queued, including pending retries
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join()
+        stats = self.stats()
+        log("Requests: %d submitted, %d coalesced, %d dropped, %d sent, %d retried, %d failed", stats["submitted"], stats["coalesced"], stats["dropped"], stats["sent"], stats["retried"], stats["failed"])
+
+
+class HedgeNettingEngine:
+    
+    # Accumulates hedge sizes per (hedge ticker, side, group), with the fill quantities
+    # per order behind them, and sends one netted hedge order per window. The group
+    # keeps apart hedges that are sent differently (the hedge template). A bucket is
+    # sent when it has been open for window seconds, or earlier once its filled
+    # quantity reaches max_quantity.
+
+    def __init__(self, window, max_quantity, hedge_ratio):
+        
+        self.window = window
+        self.max_quantity = max_quantity
+        self.hedge_ratio = hedge_ratio
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.fills = 0
+        self.orders_sent = 0
+        self.requests_saved = 0
+        self.stopping = threading.Event()
+        self.thread = None
+        
+        if self.window > 0:
+            self.thread = threading.Thread(target=self.run, name="RMSXHedgeNetting", daemon=True)
+            self.thread.start()
+
+    def add(self, ticker, side, quantity, ord_no, send, received, size=None, group=None):
+        
+        # size is the hedge quantity for the fill, by default the filled quantity
+        key = (ticker, side, group)
+        ready = None
+        
+        with self.lock:
+            self.fills += 1
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                # received is the notification time of the earliest fill in the bucket
+                bucket = self.buckets[key] = {"quantity": 0, "size": 0, "fills": 0, "opened": time.monotonic(), "orders": {}, "send": send, "received": received}
+            bucket["quantity"] += quantity
+            bucket["size"] += quantity if size is None else size
+            bucket["fills"] += 1
+            bucket["orders"][ord_no] = bucket["orders"].get(ord_no, 0) + quantity
+            
+            if self.window <= 0 or (self.max_quantity > 0 and bucket["quantity"] >= self.max_quantity):
+                ready = self.buckets.pop(key)
+        
+        if ready is not None:
+            self.send(key, ready)
+
+    def run(self):
+        
+        while not self.stopping.wait(min(self.window, 0.1)):
+            self.flush(time.monotonic() - self.window)
+
+    def flush(self, opened_before=None):
+        
+        with self.lock:
+            if opened_before is None:
+                keys = list(self.buckets.keys())
+            else:
+                keys = [key for key, bucket in self.buckets.items() if bucket["opened"] <= opened_before]
+            ready = [(key, self.buckets.pop(key)) for key in keys]
+        
+        for key, bucket in ready:
+            self.send(key, bucket)
+
+    def send(self, key, bucket):
+        
+        ticker, side, group = key
+        amount = int(round(bucket["size"] * self.hedge_ratio))
+        if amount <= 0:
+            log("Netted hedge for %s %s rounds to zero - not sent", side, ticker, level=logging.WARNING)
+            return
+        
+        with self.lock:
+            self.orders_sent += 1
+            self.requests_saved += bucket["fills"] - 1
+        
+        bucket["send"](ticker, side, amount, bucket["orders"], bucket["received"])
+
+    def stop(self):
+        
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+        log("Hedge netting: %d fills, %d hedge orders sent, %d requests saved", self.fills, self.orders_sent, self.requests_saved)
+
+
+class OrderRecord:
+    
+    __slots__ = ("side", "exchange", "ticker")
+    
+    def __init__(self, side, exchange, ticker):
+        self.side = side
+        self.exchange = exchange
+        self.ticker = ticker
+
+
+class OrderIndex:
+    
+    # Compact order attributes keyed by sequence number, kept up to date from the
+    # order notifications so route rules do not have to search the EasyMSX blotter.
+    # Orders not seen yet are looked up in EasyMSX once and then indexed. Orders in
+    # a terminal status are dropped and not indexed again, so a late lookup for one
+    # (e.g. for the last fill of a filled order) goes to EasyMSX.
+
+    FIELDS = {"EMSX_SIDE": "side", "EMSX_EXCHANGE": "exchange", "EMSX_TICKER": "ticker"}
+
+    def __init__(self, orders, terminal_statuses):
+        
+        self.orders = orders
+        self.terminal_statuses = terminal_statuses
+        self.records = {}
+
+    def add(self, o):
+        
+        record = OrderRecord(o.field("EMSX_SIDE").value(), o.field("EMSX_EXCHANGE").value(), o.field("EMSX_TICKER").value())
+        if not o.field("EMSX_STATUS").value() in self.terminal_statuses:
+            self.records[int(o.field("EMSX_SEQUENCE").value())] = record
+        return record
+
+    def update(self, o, field_changes):
+        
+        ord_no = int(o.field("EMSX_SEQUENCE").value())
+        if o.field("EMSX_STATUS").value() in self.terminal_statuses:
+            self.remove(ord_no)
+            return
+        
+        record = self.records.get(ord_no)
+        if record is None:
+            self.add(o)
+            return
+        
+        for fc in field_changes:
+            attr = self.FIELDS.get(fc.field.name())
+            if not attr is None:
+                setattr(record, attr, fc.new_value)
+
+    def remove(self, ord_no):
+        self.records.pop(ord_no, None)
+
+    def get(self, ord_no):
+        
+        record = self.records.get(ord_no)
+        if record is None:
+            o = self.orders.get_by_sequence_no(ord_no)
+            if not o is None:
+                record = self.add(o)
+        return record
+
+
+class RuleGraph:
+    
+    # Evaluates a ruleset in place of RuleMSX execution, from datapoint -> condition
+    # -> rule dependencies built from the evaluators' dependent datapoint names. For
+    # a set of changed datapoints only the rules depending on them are considered.
+    # Each rule checks its conditions in rank order and stops at the first false one,
+    # and a condition is evaluated at most once per pass, its result shared by every
+    # rule using it. A condition's rank is cost / (1 - observed true rate), so cheap
+    # conditions that usually fail run first; ranks are refreshed every REORDER passes.
+
+    REORDER = 1024
+
+    def __init__(self, name):
+        
+        self.name = name
+        self.rules = []
+        self.datapoint_rules = {}
+        self.costs = {}
+        self.evaluations = {}
+        self.true_counts = {}
+        self.passes = 0
+
+    def add_rule(self, rule_name, conditions, executor, condition_datapoints, costs):
+        
+        index = len(self.rules)
+        self.rules.append((rule_name, list(conditions), executor))
+        for condition in conditions:
+            self.costs[condition] = costs[condition]
+            self.evaluations.setdefault(condition, 0)
+            self.true_counts.setdefault(condition, 0)
+            for datapoint_name in condition_datapoints[condition]:
+                self.datapoint_rules.setdefault(datapoint_name, set()).add(index)
+        self.reorder()
+
+    def rank(self, condition):
+        
+        # Laplace-smoothed true rate, so unseen conditions rank by cost alone
+        true_rate = (self.true_counts[condition] + 1.0) / (self.evaluations[condition] + 2.0)
+        return self.costs[condition] / (1.0 - true_rate)
+
+    def reorder(self):
+        
+        self.rules = [(rule_name, sorted(conditions, key=self.rank), executor) for rule_name, conditions, executor in self.rules]
+
+    def evaluate(self, dataset, datapoint_names=None):
+        
+        if datapoint_names is None:
+            indexes = range(len(self.rules))
+        else:
+            woken = set()
+            for datapoint_name in datapoint_names:
+                woken |= self.datapoint_rules.get(datapoint_name, ())
+            indexes = sorted(woken)
+        
+        results = {}
+        for index in indexes:
+            rule_name, conditions, executor = self.rules[index]
+            for condition in conditions:
+                result = results.get(condition)
+                if result is None:
+                    result = results[condition] = bool(condition.evaluator.evaluate(dataset))
+                    self.evaluations[condition] += 1
+                    if result:
+                        self.true_counts[condition] += 1
+                if not result:
+                    break
+            else:
+                try:
+                    executor.execute(dataset)
+                except Exception as e:
+                    log("Rule %s.%s failed on %s: %s", self.name, rule_name, dataset.name, e, level=logging.ERROR)
+        
+        self.passes += 1
+        if self.passes % self.REORDER == 0:
+            self.reorder()
+
+
+class DataSetBinding:
+    
+    # Ties a dataset to the EMSX order or route it was built from. fields maps each
+    # EMSX field name to (datapoint name, rules depending on it), compiled once per
+    # ruleset. All field changes of an update are applied before anything is marked
+    # stale, and a datapoint is only marked stale if it wakes a rule that no earlier
+    # stale datapoint of the same update already woke - RuleMSX evaluates every
+    # condition of a woken rule, so one update leads to one evaluation pass. With a
+    # RuleGraph, the stale datapoints are evaluated by the graph in a single pass.
+    # attached is set once RuleMSX has executed the dataset.
+
+    __slots__ = ("dataset", "fields", "trace", "latency", "graph", "attached")
+
+    def __init__(self, dataset, fields, trace, latency, graph=None):
+        
+        self.dataset = dataset
+        self.fields = fields
+        self.trace = trace
+        self.latency = latency
+        self.graph = graph
+        self.attached = False
+
+    def apply(self, field_changes):
+        
+        received = time.perf_counter_ns()
+        datapoints = self.dataset.datapoints
+        stale = []
+        woken = set()
+        
+        for fc in field_changes:
+            name = fc.field.name()
+            binding = self.fields.get(name)
+            if binding is None:
+                continue
+            
+            datapoint_name, rules = binding
+            source = datapoints[datapoint_name].datapoint_source
+            source.update(fc.new_value)
+            
+            if rules is not None and not rules <= woken:
+                woken |= rules
+                stale.append((name, datapoint_name, source))
+        
+        if len(stale) == 0:
+            return False
+        
+        self.trace.received = received
+        self.trace.staled = time.perf_counter_ns()
+        for name, datapoint_name, source in stale:
+            self.latency.record("notify_to_stale", name, self.trace.staled - received)
+            if self.graph is None:
+                source.set_stale()
+        
+        if self.graph is not None:
+            self.graph.evaluate(self.dataset, [datapoint_name for name, datapoint_name, source in stale])
+        return True
+
+
+class DataSetRegistry:
     
-    return options
+    # Keeps the live datasets by name. Datasets whose order or route reached a
+    # terminal state are released after a grace period, so that any rule evaluation
+    # still queued for the final update (e.g. the last fill) can complete first.
+    # RuleMSX cannot detach a dataset from the execution agent of a ruleset that
+    # executed it, so such a dataset only stops receiving updates and is counted as
+    # retained rather than released.
+
+    def __init__(self, rulemsx, retire_delay, report_interval):
+        
+        self.rulemsx = rulemsx
+        self.retire_delay = retire_delay
+        self.report_interval = report_interval
+        self.datasets = {}
+        self.retiring = {}
+        self.lock = threading.Lock()
+        self.created = 0
+        self.released = 0
+        self.retained = 0
+        self.last_report = time.monotonic()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="RMSXDataSetRegistry", daemon=True)
+        self.thread.start()
+
+    def add(self, binding):
+        
+        with self.lock:
+            self.datasets[binding.dataset.name] = binding
+            self.created += 1
+
+    def get(self, name):
+        return self.datasets.get(name)
+
+    def retire(self, name):
+        
+        with self.lock:
+            if name in self.datasets and not name in self.retiring:
+                self.retiring[name] = time.monotonic() + self.retire_delay
+
+    def run(self):
+        
+        while not self.stopping.wait(1.0):
+            self.sweep()
+            if self.report_interval > 0 and time.monotonic() - self.last_report >= self.report_interval:
+                self.report()
+
+    def sweep(self):
+        
+        now = time.monotonic()
+        with self.lock:
+            expired = [name for name, when in self.retiring.items() if when <= now]
+            released = []
+            for name in expired:
+                del self.retiring[name]
+                released.append(self.datasets.pop(name))
+        
+        for binding in released:
+            self.release(binding)
+
+    def release(self, binding):
+        
+        # RuleMSX keeps every dataset it created by name; once that goes, nothing
+        # refers to a dataset it never executed
+        self.rulemsx.datasets.pop(binding.dataset.name, None)
+        with self.lock:
+            if binding.attached:
+                self.retained += 1
+            else:
+                self.released += 1
+
+    def report(self):
+        
+        self.last_report = time.monotonic()
+        live = len(self.datasets)
+        rss = resident_memory()
+        if rss is None:
+            log("Datasets: %d live, %d created, %d released, %d retained by RuleMSX", live, self.created, self.released, self.retained)
+        else:
+            log("Datasets: %d live, %d created, %d released, %d retained by RuleMSX - RSS %.1f MB, %.1f KB per held dataset", live, self.created, self.released, self.retained, rss / 1048576.0, rss / 1024.0 / max(live + self.retained, 1))
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
 
-def log(msg):
+
+class MetricsServer:
     
-    mytime= datetime.now()
-    s = mytime.strftime("%Y%m%d%H%M%S%f")
-    print(s + "(RMSXSimpleStockHedgeDemo): \t" + msg)
+    # Serves the demo's live counters in Prometheus text format on /metrics. Rates
+    # are worked out between consecutive scrapes, at least a second apart.
+
+    def __init__(self, demo, host, port):
+        
+        self.demo = demo
+        self.lock = threading.Lock()
+        self.last_scrape = None
+        self.last_counts = {}
+        self.rates = {}
+        
+        metrics = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            
+            def do_GET(self):
+                
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="RMSXMetrics", daemon=True)
+        self.thread.start()
+        log("Serving metrics on http://%s:%d/metrics", host, self.server.server_address[1])
+
+    def label(self, value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    def notification_rates(self, counts):
+        
+        by_category = {}
+        for (category, notification_type), n in counts.items():
+            by_category[category] = by_category.get(category, 0) + n
+        
+        with self.lock:
+            now = time.monotonic()
+            if self.last_scrape is None:
+                self.last_scrape = now
+                self.last_counts = by_category
+            elif now - self.last_scrape >= 1.0:
+                elapsed = now - self.last_scrape
+                self.rates = dict([(category, (n - self.last_counts.get(category, 0)) / elapsed) for category, n in by_category.items()])
+                self.last_scrape = now
+                self.last_counts = by_category
+            return dict(self.rates)
+
+    def render(self):
+        
+        demo = self.demo
+        lines = []
+        
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                if len(labels) > 0:
+                    lines.append("%s{%s} %s" % (name, ",".join(['%s="%s"' % (k, self.label(v)) for k, v in labels]), repr(float(value))))
+                else:
+                    lines.append("%s %s" % (name, repr(float(value))))
+        
+        registry = demo.datasets
+        metric("rmsx_datasets_live", "gauge", "Datasets currently held", [((), len(registry.datasets))])
+        metric("rmsx_datasets_created_total", "counter", "Datasets created", [((), registry.created)])
+        metric("rmsx_datasets_released_total", "counter", "Datasets released after retirement", [((), registry.released)])
+        metric("rmsx_datasets_retained", "gauge", "Retired datasets RuleMSX still holds", [((), registry.retained)])
+        metric("rmsx_datasets_deferred", "gauge", "Orders and routes tracked without a dataset until they can trigger a rule", [((), len(demo.stubs))])
+        
+        # The callback thread may be adding a (category, type) key, so copy under its lock
+        with demo.callback_lock:
+            counts = dict(demo.notification_counts)
+            callback_ns, callback_count, callback_max_ns = demo.callback_ns, demo.callback_count, demo.callback_max_ns
+        metric("rmsx_notifications_total", "counter", "EasyMSX notifications received", [((("category", c), ("type", t)), n) for (c, t), n in sorted(counts.items())])
+        metric("rmsx_notifications_per_second", "gauge", "EasyMSX notifications per second since the previous scrape", [((("category", c),), rate) for c, rate in sorted(self.notification_rates(counts).items())])
+        metric("rmsx_callback_seconds_sum", "counter", "Time spent in the EasyMSX notification callback", [((), callback_ns / 1e9)])
+        metric("rmsx_callback_seconds_count", "counter", "EasyMSX notification callbacks", [((), callback_count)])
+        metric("rmsx_callback_seconds_max", "gauge", "Longest EasyMSX notification callback", [((), callback_max_ns / 1e9)])
+        
+        # Every condition and action is wrapped in a counter whichever engine runs them;
+        # the rule graphs only give the rules and conditions of each ruleset
+        evaluations = []
+        executions = []
+        failures = []
+        for ruleset_name, graph in sorted(demo.rule_graphs.items()):
+            for condition in sorted(graph.costs, key=lambda condition: condition.name):
+                counter = condition.evaluator
+                evaluations.append(((("ruleset", ruleset_name), ("condition", condition.name), ("result", "true")), counter.true_count))
+                evaluations.append(((("ruleset", ruleset_name), ("condition", condition.name), ("result", "false")), counter.evaluations - counter.true_count))
+            for rule_name, conditions, counter in sorted(graph.rules, key=lambda rule: rule[0]):
+                executions.append(((("ruleset", ruleset_name), ("rule", rule_name)), counter.executions))
+                failures.append(((("ruleset", ruleset_name), ("rule", rule_name)), counter.failures))
+        metric("rmsx_condition_evaluations_total", "counter", "Condition evaluations by result", evaluations)
+        metric("rmsx_rule_executions_total", "counter", "Rule actions executed", executions)
+        metric("rmsx_rule_failures_total", "counter", "Rule actions that raised", failures)
+        
+        stats = demo.scheduler.stats()
+        metric("rmsx_requests_total", "counter", "EMSX requests by final outcome", [((("request", name), ("outcome", outcome)), n) for (name, outcome), n in sorted(stats["outcomes"].items())])
+        metric("rmsx_send_queue_depth", "gauge", "EMSX requests waiting to be sent, including retries", [((), stats["queued"] + stats["retrying"])])
+        for key in ("coalesced", "dropped", "retried"):
+            metric("rmsx_requests_%s_total" % key, "counter", "EMSX requests %s" % key, [((), stats[key])])
+        
+        refdata = demo.refdata
+        metric("rmsx_refdata_lookups_total", "counter", "Reference data cache lookups", [((("result", "hit"),), refdata.hits), ((("result", "miss"),), refdata.misses)])
+        metric("rmsx_refdata_requests_total", "counter", "Bulk reference data requests sent", [((), refdata.requests)])
+        
+        return "\n".join(lines) + "\n"
+
+    def stop(self):
+        
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
 
 
 class RMSXSimpleStockHedgeDemo:
     
-    def __init__(self, options):
+    TERMINAL_STATUSES = frozenset(["FILLED", "CANCEL", "CANCELLED", "EXPIRED"])
+    ORDER_REFDATA_FIELDS = ["VOLUME_AVG_20D", "EXCH_CODE"]
+    ORDER_FIELDS = ["EMSX_SEQUENCE", "EMSX_STATUS", "EMSX_TICKER", "EMSX_AMOUNT", "EMSX_NOTES", "EMSX_EXCHANGE", "EMSX_SIDE"]
+    ROUTE_FIELDS = ["EMSX_SEQUENCE", "EMSX_ROUTE_ID", "EMSX_STATUS", "EMSX_FILLED", "EMSX_AMOUNT", "EMSX_LAST_SHARES", "EMSX_NOTES"]
+    
+    # (datapoint, EMSX field, parse) for the datapoints backed by order/route fields
+    ORDER_DATAPOINTS = (
+        ("OrderStatus", "EMSX_STATUS", None),
+        ("OrderTicker", "EMSX_TICKER", None),
+        ("OrderNumber", "EMSX_SEQUENCE", to_int),
+        ("OrderAmount", "EMSX_AMOUNT", to_int),
+        ("OrderNotes", "EMSX_NOTES", None))
+    ROUTE_DATAPOINTS = (
+        ("RouteStatus", "EMSX_STATUS", None),
+        ("RouteOrderNumber", "EMSX_SEQUENCE", to_int),
+        ("RouteID", "EMSX_ROUTE_ID", to_int),
+        ("RouteFilled", "EMSX_FILLED", to_int),
+        ("RouteAmount", "EMSX_AMOUNT", to_int),
+        ("RouteLastShares", "EMSX_LAST_SHARES", to_int),
+        ("RouteNotes", "EMSX_NOTES", None))
+
+    def __init__(self, options, easymsx=None, easymkt=None):
+        
+        # easymsx/easymkt may be given to run against another backend (see RMSXSimpleStockHedgeReplay.py)
 
         self.options = options
         self.easymsx = None
+        self.templates, self.strategies = load_strategies(options)
+        self.hedge_tickers = sorted(set([strategy.hedge_ticker for strategy in self.strategies if strategy.hedge_ticker is not None]))
+        
+        # The EasyMKT and EasyMSX sessions open in parallel, while everything that
+        # does not need them is set up here
+        started = time.perf_counter()
+        startup = ThreadPoolExecutor(max_workers=2, thread_name_prefix="RMSXStartup")
+        easymkt_started = startup.submit(self.open_session, "EasyMKT", EasyMKT, easymkt)
+        easymsx_started = startup.submit(self.open_session, "EasyMSX", EasyMSX, easymsx)
+        
+        self.recorder = None
+        if options.record is not None:
+            self.recorder = NotificationRecorder(options.record)
+        self.pending_orders = []
+        self.pending_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.initial_paint_done = False
+        self.initial_paint_flushed = threading.Event()
+        self.last_paint = None
+        self.conditions = {}
+        self.condition_datapoints = {}
+        self.condition_costs = {}
+        self.action_executors = {}
+        self.rule_datapoints = {}
+        self.rule_graphs = {}
+        self.notification_counts = {}
+        self.callback_lock = threading.Lock()
+        self.callback_ns = 0
+        self.callback_count = 0
+        self.callback_max_ns = 0
+        self.metrics = None
+        self.field_bindings = {}
+        self.stubs = set()
+        self.snapshot = None
+        if options.snapshot is not None:
+            self.snapshot = WarmStartSnapshot(options.snapshot, options.shard)
         
         log("Initialising RuleMSX...")
         self.rulemsx = RuleMSX(logging.CRITICAL)
+        self.latency = LatencyRecorder(options.latency, options.latency_export, options.latency_file)
+        self.datasets = DataSetRegistry(self.rulemsx, options.retire_delay, options.memory_report)
         log("RuleMSX initialised...")
-        
-        log("Initialising EasyMKT...")
-        self.easymkt = EasyMKT()
-        log("EasyMKT initialised...")
 
-        log("Initialising EasyMSX...")
-        self.easymsx = EasyMSX()
-        log("EasyMSX initialised...")
+        if options.dispatch_workers > 0:
+            self.dispatcher = ThreadPoolDispatcher(options.dispatch_workers, options.dispatch_queue)
+        else:
+            self.dispatcher = SynchronousDispatcher()
+
+        self.hedge_netting = HedgeNettingEngine(options.hedge_window, options.hedge_max_qty, options.hedge_ratio)
+        
+        self.easymkt = easymkt_started.result()
+        self.refdata = RefDataCache(self.easymkt, options.refdata_ttl, options.refdata_batch, self.recorder, self.snapshot)
+        if self.snapshot is not None:
+            self.refdata.restore(self.snapshot.refdata)
+        self.sizer = None
+        if options.hedge_sizing == "beta":
+            self.sizer = HedgeSizer(self.refdata, options.beta_field, options.price_field, options.market_data_refresh)
+        self.screen = InitialPaintScreen(self.refdata, self.strategies)
+
+        self.easymsx = easymsx_started.result()
+        startup.shutdown()
+        self.order_index = OrderIndex(self.easymsx.orders, self.TERMINAL_STATUSES)
+        self.scheduler = RequestScheduler(self.easymsx, self.dispatcher, self.latency, options.send_rate, options.send_burst, options.send_queue, options.retry_attempts, options.retry_backoff, options.retry_codes)
         
         log("Build rules...")
         self.build_rules()
@@ -59,11 +2060,48 @@ class RMSXSimpleStockHedgeDemo:
         log("Add route notification handler")
         self.easymsx.routes.add_notification_handler(self.process_notification)
 
+        if options.metrics_port > 0:
+            self.metrics = MetricsServer(self, options.metrics_host, options.metrics_port)
+
         log("Starting EasyMSX...")
+        self.last_paint = time.monotonic()
         self.easymsx.start()
         log("EasyMSX started.")
         
-    class StringEqualityEvaluator(RuleEvaluator):
+        self.wait_for_initial_paint()
+        self.resume_hedges()
+        
+        log("Started in %.3fs: %d datasets, %d orders and routes deferred", time.perf_counter() - started, len(self.datasets.datasets), len(self.stubs))
+        
+    def open_session(self, name, factory, session):
+        
+        # session is the one given to the constructor, if any
+        if session is not None:
+            return session
+        log("Initialising %s...", name)
+        session = factory()
+        log("%s initialised...", name)
+        return session
+
+    def stop(self):
+        
+        if self.metrics is not None:
+            self.metrics.stop()
+        self.rulemsx.stop()
+        self.report_rules()
+        self.hedge_netting.stop()
+        self.scheduler.stop()
+        if self.sizer is not None:
+            self.sizer.stop()
+        self.latency.stop()
+        self.dispatcher.shutdown()
+        self.datasets.stop()
+        if self.recorder is not None:
+            self.recorder.stop()
+        if self.snapshot is not None:
+            self.snapshot.stop()
+        
+    class StringEqualityEvaluator(DemoRuleEvaluator):
         
         def __init__(self, datapoint_name, target_value, additional_dep=None):
             
@@ -82,7 +2120,7 @@ class RMSXSimpleStockHedgeDemo:
             #print("Evaluated StringEqualityEvaluator for DataPoint: " + self.datapoint_name + " of DataSet: " + dataset.name + " - Returning: " + str(dp_value==self.target_value))
             return dp_value==self.target_value
         
-    class StringInequalityEvaluator(RuleEvaluator):
+    class StringInequalityEvaluator(DemoRuleEvaluator):
         
         def __init__(self, datapoint_name, target_value, additional_dep=None):
             
@@ -97,175 +2135,179 @@ class RMSXSimpleStockHedgeDemo:
             #print("Initialized StringEqualityEvaluator for DataPoint: " + datapoint_name)
         
         def evaluate(self,dataset):
-            dp_value = dataset.datapoints[self.datapoint_name].get_value()[:len(self.target_value)]
-            #print("Evaluated StringEqualityEvaluator for DataPoint: " + self.datapoint_name + " of DataSet: " + dataset.name + " - Returning: " + str(dp_value==self.target_value))
-            return dp_value!=self.target_value
+            dp_value = dataset.datapoints[self.datapoint_name].get_value()
+            #print("Evaluated StringInequalityEvaluator for DataPoint: " + self.datapoint_name + " of DataSet: " + dataset.name)
+            return dp_value is None or not dp_value.startswith(self.target_value)
 
 
-    class OrderAmountThresholdEvaluator(RuleEvaluator):
+    class StringMembershipEvaluator(DemoRuleEvaluator):
         
-        def __init__(self):
+        def __init__(self, datapoint_name, target_values):
             
-            super().add_dependent_datapoint_name("OrderAmount")
+            self.datapoint_name = datapoint_name
+            self.target_values = frozenset(target_values)
+            super().add_dependent_datapoint_name(datapoint_name)
         
         def evaluate(self,dataset):
-            order_amount = float(dataset.datapoints["OrderAmount"].get_value())
-            trigger_threshold = float(dataset.datapoints["TriggerThreshold"].get_value())
-            avg_vol = float(dataset.datapoints["20DayAvgVol"].get_value())
-            
-            #print("Order Amount: " + order_amount)
-            #print("Trigger Threshold: " + trigger_threshold)
-            #print("Average Volume: %f" %(avg_vol))
-
-            return order_amount < (trigger_threshold * avg_vol)
+            return dataset.datapoints[self.datapoint_name].get_value() in self.target_values
 
+    class TickerPatternEvaluator(DemoRuleEvaluator):
+        
+        # Matches the strategy's fnmatch ticker patterns
+        COST = 2
+        
+        def __init__(self, datapoint_name, strategy):
+            
+            self.datapoint_name = datapoint_name
+            self.strategy = strategy
+            super().add_dependent_datapoint_name(datapoint_name)
+        
+        def evaluate(self,dataset):
+            return self.strategy.matches_ticker(dataset.datapoints[self.datapoint_name].get_value())
 
-    class SendNewRouteBB(Action):
+    class StrategyExclusionEvaluator(DemoRuleEvaluator):
+        
+        # True if none of the earlier strategies covers the order
+        COST = 2
         
-        def __init__(self, easymsx):
+        def __init__(self, strategies):
             
-            self.easymsx = easymsx
-            self.done = False
+            self.strategies = strategies
+            super().add_dependent_datapoint_name("Exchange")
+            super().add_dependent_datapoint_name("OrderTicker")
+        
+        def evaluate(self,dataset):
+            exchange = dataset.datapoints["Exchange"].get_value()
+            ticker = dataset.datapoints["OrderTicker"].get_value()
+            return not any([strategy.matches(exchange, ticker) for strategy in self.strategies])
+
+    class OrderAmountThresholdEvaluator(DemoRuleEvaluator):
+        
+        # Reads reference data backed datapoints
+        COST = 4
+        
+        def __init__(self, percentage):
             
-            pass
+            self.percentage = percentage
+            super().add_dependent_datapoint_name("OrderAmount")
         
-        def execute(self,dataset):
+        def evaluate(self,dataset):
             
-            req = self.easymsx.create_request("RouteEx")
+            # TriggerVolume keeps percentage * 20 day average volume per dataset
+            order_amount = dataset.datapoints["OrderAmount"].datapoint_source.get_number()
+            trigger_volume = dataset.datapoints["TriggerVolume"].datapoint_source.volume(self.percentage)
             
-            ord_no = dataset.datapoints["OrderNumber"].get_value()
-            req.set("EMSX_SEQUENCE", ord_no)
-            req.set("EMSX_AMOUNT", dataset.datapoints["OrderAmount"].get_value())
-            req.set("EMSX_BROKER", "BB")
-            req.set("EMSX_HAND_INSTRUCTION", "ANY")
-            req.set("EMSX_ORDER_TYPE", "MKT")
-            req.set("EMSX_TICKER", dataset.datapoints["OrderTicker"].get_value())
-            req.set("EMSX_TIF", "DAY")
-
-            msg = self.easymsx.send_request(req)
-            
-            if msg.messageType()=="ErrorInfo":
-                print("Failed to route order: " + ord_no)
-                errorCode = msg.getElementAsInteger("ERROR_CODE")
-                errorMessage = msg.getElementAsString("ERROR_MESSAGE")
-                print ("ERROR CODE: %d\tERROR MESSAGE: %s" % (errorCode,errorMessage))
-            else:
-                print("Created route for order: " + ord_no)
-                
+            if order_amount is None or trigger_volume is None:
+                return False
+
+            return order_amount < trigger_volume
 
-    class SendNewRouteBMTB(Action):
+
+    class SendNewRoute(Action):
         
-        def __init__(self,easymsx):
+        def __init__(self, easymsx, template, scheduler, latency):
             
             self.easymsx = easymsx
+            self.template = template
+            self.scheduler = scheduler
+            self.latency = latency
             self.done = False
             
             pass
         
         def execute(self,dataset):
             
-            req = self.easymsx.create_request("RouteEx")
-            
             ord_no = dataset.datapoints["OrderNumber"].get_value()
+            
+            values = (
+                ("EMSX_SEQUENCE", ord_no),
+                ("EMSX_AMOUNT", dataset.datapoints["OrderAmount"].get_value()),
+                ("EMSX_TICKER", dataset.datapoints["OrderTicker"].get_value()))
 
-            req.set("EMSX_SEQUENCE", ord_no)
-            req.set("EMSX_AMOUNT", dataset.datapoints["OrderAmount"].get_value())
-            req.set("EMSX_BROKER", "BMTB")
-            req.set("EMSX_HAND_INSTRUCTION", "ANY")
-            req.set("EMSX_ORDER_TYPE", "MKT")
-            req.set("EMSX_TICKER", dataset.datapoints["OrderTicker"].get_value())
-            req.set("EMSX_TIF", "DAY")
-
-            strategy = req.getElement("EMSX_STRATEGY_PARAMS")
-            strategy.setElement("EMSX_STRATEGY_NAME", "VWAP")
-                
-            indicator = strategy.getElement("EMSX_STRATEGY_FIELD_INDICATORS")
-            data = strategy.getElement("EMSX_STRATEGY_FIELDS")
-                
-            data.appendElement().setElement("EMSX_FIELD_DATA", "09:30:00")  # StartTime
-            indicator.appendElement().setElement("EMSX_FIELD_INDICATOR", 0)
-
-            data.appendElement().setElement("EMSX_FIELD_DATA", "10:30:00")   # EndTime
-            indicator.appendElement().setElement("EMSX_FIELD_INDICATOR", 0)
-
-            data.appendElement().setElement("EMSX_FIELD_DATA", "")           # Max%Volume
-            indicator.appendElement().setElement("EMSX_FIELD_INDICATOR", 1)
-               
-            data.appendElement().setElement("EMSX_FIELD_DATA", "")           # %AMSession
-            indicator.appendElement().setElement("EMSX_FIELD_INDICATOR", 1)
-
-            data.appendElement().setElement("EMSX_FIELD_DATA", "")           # OPG
-            indicator.appendElement().setElement("EMSX_FIELD_INDICATOR", 1)
-
-            data.appendElement().setElement("EMSX_FIELD_DATA", "")           # MOC
-            indicator.appendElement().setElement("EMSX_FIELD_INDICATOR", 1)
-
-            data.appendElement().setElement("EMSX_FIELD_DATA", "")           # CompletePX
-            indicator.appendElement().setElement("EMSX_FIELD_INDICATOR", 1)
-               
-            data.appendElement().setElement("EMSX_FIELD_DATA", "")           # TriggerPX
-            indicator.appendElement().setElement("EMSX_FIELD_INDICATOR", 1)
-
-            data.appendElement().setElement("EMSX_FIELD_DATA", "")           # DarkComplete
-            indicator.appendElement().setElement("EMSX_FIELD_INDICATOR", 1)
-
-            data.appendElement().setElement("EMSX_FIELD_DATA", "")           # DarkCompPX
-            indicator.appendElement().setElement("EMSX_FIELD_INDICATOR", 1)
-
-            data.appendElement().setElement("EMSX_FIELD_DATA", "")           # RefIndex
-            indicator.appendElement().setElement("EMSX_FIELD_INDICATOR", 1)
-
-            data.appendElement().setElement("EMSX_FIELD_DATA", "")           # Discretion
-            indicator.appendElement().setElement("EMSX_FIELD_INDICATOR", 1)
+            received = dataset.datapoints["Trace"].get_value().received
+            self.scheduler.submit(self.RouteRequest(self.template, values, ord_no, received))
 
-            msg = self.easymsx.send_request(req)
+        class RouteRequest(ScheduledRequest):
             
-            if msg.messageType()=="ErrorInfo":
-                print("Failed to route order: " + ord_no)
-                errorCode = msg.getElementAsInteger("ERROR_CODE")
-                errorMessage = msg.getElementAsString("ERROR_MESSAGE")
-                print ("ERROR CODE: %d\tERROR MESSAGE: %s" % (errorCode,errorMessage))
-            else:
-                print("Created route for order: " + ord_no)
+            def __init__(self, template, values, ord_no, received):
+                super().__init__("SendNewRoute:" + template.name, ord_no, received)
+                self.template = template
+                self.values = values
             
-    class ConstDataPointSource(DataPointSource):
-        
-        def __init__(self, value):
-            self.value=value
+            def build(self, easymsx):
+                return self.template.build(easymsx, self.values)
+            
+            def completed(self, msg):
+                report_response(msg, "Created route for order: " + str(self.key), "Failed to route order: " + str(self.key))
             
-        def get_value(self):
-            return self.value
-        
     class GetRefDataField(DataPointSource):
         
-        def __init__(self, easymkt, ticker_source, field):
+        def __init__(self, refdata, ticker_source, field):
 
-            self.easymkt = easymkt
+            self.refdata = refdata
             self.ticker_source = ticker_source
             self.field = field
+            self.parsed = None
+            self.number = None
+        
+        def get_value(self):
             
-            req = self.easymkt.create_request("ReferenceDataRequest")
-            
-            req.append("securities", ticker_source)
-            req.append("fields", field)
-
-            msg=self.easymkt.send_request(req)
-
-            #print (msg)
+            return self.refdata.get(self.ticker_source, self.field)
+        
+        def get_number(self):
             
-            self.value = msg.getElement("securityData").getValue(0).getElement("fieldData").getElement(field).getValue()
+            value = self.get_value()
+            if not value is self.parsed:
+                self.parsed = value
+                self.number = to_number(value)
+            return self.number
+    
+    class TriggerVolumeDataPointSource(DataPointSource):
+        
+        # Trigger percentage x 20 day average volume, per percentage the strategies
+        # use. Worked out on first use and again only once the reference data cache
+        # has stored new values or the average volume has expired.
+        
+        def __init__(self, avg_vol_source):
+            self.avg_vol_source = avg_vol_source
+            self.volumes = {}
+            self.avg_vol = None
+            self.generation = None
+            self.expires = 0.0
         
         def get_value(self):
+            return self.volumes
+        
+        def volume(self, percentage):
             
-            return self.value
+            refdata = self.avg_vol_source.refdata
+            if self.generation != refdata.generation or time.monotonic() >= self.expires:
+                # The generation is taken first, so a refresh during the lookup is seen next time
+                self.generation = refdata.generation
+                self.avg_vol = self.avg_vol_source.get_number()
+                self.expires = refdata.expiry(self.avg_vol_source.ticker_source, self.avg_vol_source.field)
+                self.volumes = {}
+            
+            volume = self.volumes.get(percentage)
+            if volume is None and self.avg_vol is not None:
+                volume = self.volumes[percentage] = percentage * self.avg_vol
+            return volume
     
     class EMSXFieldDataPointSource(DataPointSource):
 
-        def __init__(self, field):
-            self.source = field
-            self.value = self.source.value()
-            self.previous_value = None
-            self.source.add_notification_handler(self.process_notification)
+        # Values are stored converted by parse (e.g. to_int for quantities), so
+        # evaluators work with typed values rather than re-parsing strings. Changes
+        # arrive through the dataset's DataSetBinding, not a handler per field.
+        
+        def __init__(self, value, parse=None, previous_value=None):
+            self.parse = parse
+            self.value = self.convert(value)
+            self.previous_value = previous_value
+            
+        def convert(self, value):
+            if self.parse is None:
+                return value
+            return self.parse(value)
             
         def get_value(self):
             return self.value
@@ -273,29 +2315,34 @@ class RMSXSimpleStockHedgeDemo:
         def get_previous_value(self):
             return self.previous_value
         
-        def process_notification(self, notification):
-            print("process_notification of EMSXFieldDataPointSource for field: " + self.source.name() +"(" + notification.source.field("EMSX_SEQUENCE").value() + ")" )
-            for fc in notification.field_changes:
-                print ("    >> " + fc.field.name() + ": " + fc.old_value + " / " + fc.new_value)
-
+        def get_number(self):
+            if self.parse is None:
+                return to_number(self.value)
+            return self.value
+        
+        def get_previous_number(self):
+            if self.parse is None:
+                return to_number(self.previous_value)
+            return self.previous_value
+        
+        def update(self, value):
             self.previous_value = self.value
-            self.value = notification.field_changes[0].new_value                
-            super().set_stale()
+            self.value = self.convert(value)
      
 
-    class RouteFillOccured(RuleEvaluator):
+    class RouteFillOccured(DemoRuleEvaluator):
         
         def __init__(self):
-            print("Add route fill occured - setting dependency on RouteFilled datapoint")
+            log("Add route fill occured - setting dependency on RouteFilled datapoint")
             super().add_dependent_datapoint_name("RouteFilled")
         
         def evaluate(self,dataset):
 
             field_source = dataset.datapoints["RouteFilled"].datapoint_source
             
-            current_filled =  int(field_source.get_value())
+            current_filled =  int(field_source.get_number() or 0)
             
-            pf = field_source.get_previous_value()
+            pf = field_source.get_previous_number()
             if not pf is None:
                 previous_filled =  int(pf)
             else:
@@ -304,73 +2351,205 @@ class RMSXSimpleStockHedgeDemo:
             if current_filled > previous_filled:
                 filled_amount = current_filled - previous_filled
                 dataset.datapoints["FillAmount"].datapoint_source.set_value(filled_amount)
-                print("Fill detected: " + str(filled_amount))
+                log("Fill detected: %d", filled_amount, level=logging.DEBUG)
                 return True
             else:
-                print("No Fill detected (Current: %d  Previous: %d)" % (current_filled, previous_filled))
+                log("No Fill detected (Current: %d  Previous: %d)", current_filled, previous_filled, level=logging.DEBUG)
                 return False
             
 
-    class RouteExchangeUS(RuleEvaluator):
+    class RouteOrderMatches(DemoRuleEvaluator):
         
-        def __init__(self,easymsx):
-            self.easymsx = easymsx
+        # Looks the order up in the index, or in EasyMSX if it is not indexed, and
+        # checks that the strategy, and none of the earlier ones, covers its exchange
+        # and ticker
+        COST = 2
+        
+        def __init__(self, order_index, strategy, earlier=()):
+            self.order_index = order_index
+            self.strategy = strategy
+            self.earlier = tuple(earlier)
             super().add_dependent_datapoint_name("RouteOrderNumber")
         
         def evaluate(self,dataset):
 
-            ord_no = int(dataset.datapoints["RouteOrderNumber"].get_value())
-            print("looking for order: " + str(ord_no))
-            o = self.easymsx.orders.get_by_sequence_no(ord_no)
+            ord_no = dataset.datapoints["RouteOrderNumber"].get_value()
+            log("looking for order: %s", ord_no, level=logging.DEBUG)
+            o = self.order_index.get(ord_no)
             
-            exch=""
-            
-            if not o is None:
-                print("Found order.")
-                exch = o.field("EMSX_EXCHANGE").value()
-            else:
-                print("Failed to find order.")
+            if o is None:
+                log("Failed to find order: %s", ord_no, level=logging.WARNING)
+                return False
 
-            print("Evaluating fill route exchange: " + exch + "(returning : " + str(exch=="US") + ")")
-            return exch=="US"
+            matches = self.strategy.matches(o.exchange, o.ticker) and not any([strategy.matches(o.exchange, o.ticker) for strategy in self.earlier])
+            log("Evaluating fill route order: %s %s (returning : %s)", o.exchange, o.ticker, matches, level=logging.DEBUG)
+            return matches
+        
+    class TimedEvaluator(DemoRuleEvaluator):
+        
+        # Wraps an evaluator to record how long after the datapoint went stale it ran, and for how long
+        
+        def __init__(self, name, evaluator, latency):
+            self.name = name
+            self.evaluator = evaluator
+            self.latency = latency
+            self.COST = evaluator.COST
+            for datapoint_name in getattr(evaluator, "dependent_names", None) or []:
+                self.add_dependent_datapoint_name(datapoint_name)
+        
+        def evaluate(self, dataset):
+            start = time.perf_counter_ns()
+            self.latency.record("stale_to_condition", self.name, start - dataset.datapoints["Trace"].get_value().staled)
+            result = self.evaluator.evaluate(dataset)
+            self.latency.since("condition_eval", self.name, start)
+            return result
+
+    class CountingEvaluator(DemoRuleEvaluator):
         
+        # Wraps every evaluator, whichever engine runs it, to count evaluations and
+        # how many were true
+        
+        def __init__(self, evaluator):
+            self.evaluator = evaluator
+            self.evaluations = 0
+            self.true_count = 0
+            self.COST = evaluator.COST
+            for datapoint_name in getattr(evaluator, "dependent_names", None) or []:
+                self.add_dependent_datapoint_name(datapoint_name)
+        
+        def evaluate(self, dataset):
+            result = self.evaluator.evaluate(dataset)
+            self.evaluations += 1
+            if result:
+                self.true_count += 1
+            return result
+
+    class CountingAction(Action):
+        
+        # Wraps every action to count executions and the ones that raised
+        
+        def __init__(self, action):
+            self.action = action
+            self.executions = 0
+            self.failures = 0
+        
+        def execute(self, dataset):
+            self.executions += 1
+            try:
+                self.action.execute(dataset)
+            except Exception:
+                self.failures += 1
+                raise
+
+    class TimedAction(Action):
+        
+        def __init__(self, name, action, latency):
+            self.name = name
+            self.action = action
+            self.latency = latency
+        
+        def execute(self, dataset):
+            start = time.perf_counter_ns()
+            self.latency.record("notify_to_action", self.name, start - dataset.datapoints["Trace"].get_value().received)
+            self.action.execute(dataset)
+            self.latency.since("action_exec", self.name, start)
+
     class SendHedgeOrder(Action):
         
-        def __init__(self, easymsx):
+        def __init__(self, easymsx, template, hedge_ticker, order_index, scheduler, netting, sizer, latency, snapshot):
             
             self.easymsx = easymsx
+            self.template = template
+            self.hedge_ticker = hedge_ticker
+            self.order_index = order_index
+            self.scheduler = scheduler
+            self.netting = netting
+            self.sizer = sizer
+            self.latency = latency
+            self.snapshot = snapshot
             self.done = False
             
             pass
         
         def execute(self,dataset):
             
-            ord_no = int(dataset.datapoints["RouteOrderNumber"].get_value())
-            o = self.easymsx.orders.get_by_sequence_no(ord_no)
-
-            req = self.easymsx.create_request("CreateOrderAndRouteEx")
+            # The fill is recorded as seen before it is handed to hedging, so a restart
+            # in between finds it unhedged rather than losing it
+            ord_no = dataset.datapoints["RouteOrderNumber"].get_value()
+            received = dataset.datapoints["Trace"].get_value().received
+            if self.snapshot is not None:
+                self.snapshot.record_route_filled(ord_no, dataset.datapoints["RouteID"].get_value(), dataset.datapoints["RouteFilled"].get_value())
+            self.hedge(self.hedge_ticker, ord_no, dataset.datapoints["FillAmount"].get_value(), received)
+
+        def hedge(self, ticker, ord_no, quantity, received):
+            
+            o = self.order_index.get(ord_no)
+            
+            if o is None:
+                log("Failed to find order %s - hedge not sent", ord_no, level=logging.ERROR)
+                return False
 
-            req.set("EMSX_TICKER", dataset.datapoints["HedgeTicker"].get_value())
-            req.set("EMSX_AMOUNT", dataset.datapoints["HedgeAmount"].get_value())
-            req.set("EMSX_ORDER_TYPE", "MKT")
-            req.set("EMSX_TIF", "DAY")
-            req.set("EMSX_HAND_INSTRUCTION", "ANY")
-            if o.field("EMSX_SIDE").value() == "BUY":
-                req.set("EMSX_SIDE", "SELL")
+            if o.side == "BUY":
+                side = "SELL"
             else:
-                req.set("EMSX_SIDE", "BUY")
-            req.set("EMSX_BROKER", "EFIX")
-            req.set("EMSX_NOTES","HEDGE:" + str(ord_no))
+                side = "BUY"
+            
+            size = None
+            if self.sizer is not None:
+                size = self.sizer.size(o.ticker, ticker, quantity)
+                if size < 0:
+                    # A negative beta is hedged on the same side as the fill, netted only with other such hedges
+                    side = "BUY" if side == "SELL" else "SELL"
+                    size = -size
+            
+            self.netting.add(ticker, side, quantity, ord_no, self.send_hedge, received, size, self.template.name)
+            return True
 
-            msg = self.easymsx.send_request(req)
+        def send_hedge(self, ticker, side, amount, fills, received):
             
-            if msg.messageType()=="ErrorInfo":
-                print("Failed to create hedge order: " + ord_no)
-                errorCode = msg.getElementAsInteger("ERROR_CODE")
-                errorMessage = msg.getElementAsString("ERROR_MESSAGE")
-                print ("ERROR CODE: %d\tERROR MESSAGE: %s" % (errorCode,errorMessage))
-            else:
-                print("Created hedge order for : " + str(ord_no))
+            # fills maps each order number to its filled quantity in this hedge
+            self.scheduler.submit(self.HedgeRequest(self.template, self.snapshot, ticker, side, amount, dict(fills), received))
+
+        class HedgeRequest(CoalescingRequest):
+            
+            # Sent ahead of new routes; a hedge still queued for the same ticker, side
+            # and template takes over the amount and fills of later ones
+            
+            PRIORITY = 0
+            
+            def __init__(self, template, snapshot, ticker, side, amount, fills, received):
+                super().__init__("SendHedgeOrder", (ticker, side, template.name), received, (ticker, side, template.name))
+                self.template = template
+                self.snapshot = snapshot
+                self.ticker = ticker
+                self.side = side
+                self.amount = amount
+                self.fills = fills
+            
+            def merge(self, other):
+                self.amount += other.amount
+                for ord_no, quantity in other.fills.items():
+                    self.fills[ord_no] = self.fills.get(ord_no, 0) + quantity
+            
+            def build(self, easymsx):
+                
+                order_numbers = list(self.fills.keys())
+                if len(order_numbers) == 1:
+                    notes = "HEDGE:" + str(order_numbers[0])
+                else:
+                    notes = "HEDGE:" + str(order_numbers[0]) + "+" + str(len(order_numbers) - 1)
+                
+                return self.template.build(easymsx, (
+                    ("EMSX_TICKER", self.ticker),
+                    ("EMSX_AMOUNT", self.amount),
+                    ("EMSX_SIDE", self.side),
+                    ("EMSX_NOTES", notes)))
+            
+            def completed(self, msg):
+                
+                orders = ",".join([str(n) for n in self.fills.keys()])
+                if report_response(msg, "Created hedge order for : " + orders, "Failed to create hedge order: " + orders) and self.snapshot is not None:
+                    self.snapshot.record_hedged(self.fills)
 
             
     class GenericValueDataPointSource(DataPointSource):
@@ -387,108 +2566,462 @@ class RMSXSimpleStockHedgeDemo:
 
 
 
-    def build_rules(self):
+    def create_condition(self, name, evaluator):
         
-        log("Building Rules...")
-
-        cond_order_status_new = RuleCondition("OrderStatusIsNew", self.StringEqualityEvaluator("OrderStatus","NEW"))
-        cond_order_not_hedge = RuleCondition("OrderNotHedge", self.StringInequalityEvaluator("OrderNotes","HEDGE"))
-        cond_order_amount_trigger = RuleCondition("OrderAmountTrigger", self.OrderAmountThresholdEvaluator())
-        cond_order_exchange_US = RuleCondition("OrderExchangeUS", self.StringEqualityEvaluator("Exchange","US"))
-        cond_order_exchange_LN = RuleCondition("OrderExchangeLN", self.StringEqualityEvaluator("Exchange","LN"))
-
-        action_order_send_new_route_BB = self.rulemsx.create_action("OrderSendNewRouteBB", self.SendNewRouteBB(self.easymsx))
-        action_order_send_new_route_BMTB = self.rulemsx.create_action("OrderSendNewRouteBMTB", self.SendNewRouteBMTB(self.easymsx))
-
-        demo_order_ruleset = self.rulemsx.create_ruleset("demoOrderRuleSet")
+        if self.latency.enabled:
+            evaluator = self.TimedEvaluator(name, evaluator, self.latency)
+        evaluator = self.CountingEvaluator(evaluator)
+        condition = RuleCondition(name, evaluator)
+        self.condition_datapoints[condition] = getattr(evaluator, "dependent_names", None) or []
+        self.condition_costs[condition] = getattr(evaluator, "COST", DemoRuleEvaluator.COST)
+        return condition
+
+    def create_action(self, name, executor):
+        
+        # name is "<rule>/<action>"; RuleMSX knows the action by the part after the /
+        if self.latency.enabled:
+            executor = self.TimedAction(name, executor, self.latency)
+        executor = self.CountingAction(executor)
+        action = self.rulemsx.create_action(name.split("/")[-1], executor)
+        self.action_executors[action] = executor
+        return action
+
+    def add_rule(self, ruleset, rule_name, conditions, action):
         
-        rule_new_order_US = demo_order_ruleset.add_rule("NewOrderUS")
-        rule_new_order_US.add_rule_condition(cond_order_status_new)
-        rule_new_order_US.add_rule_condition(cond_order_not_hedge)
-        rule_new_order_US.add_rule_condition(cond_order_amount_trigger)
-        rule_new_order_US.add_rule_condition(cond_order_exchange_US)
-        rule_new_order_US.add_action(action_order_send_new_route_BB)
+        # Also records, per ruleset, which rules each datapoint can wake (see
+        # compile_field_bindings), and adds the rule to the ruleset's RuleGraph.
+        # Conditions are added cheapest first.
+        conditions = sorted(conditions, key=lambda condition: self.condition_costs[condition])
+        self.rule_graphs[ruleset.name].add_rule(rule_name, conditions, self.action_executors[action], self.condition_datapoints, self.condition_costs)
         
-        rule_new_order_LN = demo_order_ruleset.add_rule("NewOrderLN")
-        rule_new_order_LN.add_rule_condition(cond_order_status_new)
-        rule_new_order_LN.add_rule_condition(cond_order_not_hedge)
-        rule_new_order_LN.add_rule_condition(cond_order_amount_trigger)
-        rule_new_order_LN.add_rule_condition(cond_order_exchange_LN)
-        rule_new_order_LN.add_action(action_order_send_new_route_BMTB)
+        rule = ruleset.add_rule(rule_name)
+        datapoints = self.rule_datapoints.setdefault(ruleset, {})
+        for condition in conditions:
+            rule.add_rule_condition(condition)
+            for datapoint_name in self.condition_datapoints[condition]:
+                datapoints.setdefault(datapoint_name, set()).add(rule_name)
+        rule.add_action(action)
+        return rule
+
+    def report_rules(self):
+        
+        for ruleset_name, graph in self.rule_graphs.items():
+            for rule_name, conditions, counter in graph.rules:
+                log("Rule %s.%s: %d executions, %d failed - %s", ruleset_name, rule_name, counter.executions, counter.failures, ", ".join(["%s %d/%d" % (c.name, c.evaluator.true_count, c.evaluator.evaluations) for c in conditions]))
 
+    def compile_field_bindings(self, ruleset, datapoints):
+        
+        # EMSX field -> (datapoint, rules woken by it); fields no condition depends on
+        # still update their datapoint, but never mark it stale
+        dependencies = self.rule_datapoints.get(ruleset, {})
+        fields = {}
+        for datapoint_name, field_name, parse in datapoints:
+            rules = dependencies.get(datapoint_name)
+            fields[field_name] = (datapoint_name, None if rules is None else frozenset(rules))
+        
+        log("Ruleset %s wakes on: %s", ruleset.name, ", ".join(sorted([f for f, b in fields.items() if b[1] is not None])))
+        return fields
 
-        cond_route_fill_occured = RuleCondition("RouteFillOccured", self.RouteFillOccured())
-        cond_route_exchange_US = RuleCondition("RouteExchangeUS", self.RouteExchangeUS(self.easymsx))
-        cond_route_not_hedge = RuleCondition("RouteNotHedge", self.StringInequalityEvaluator("RouteNotes","HEDGE"))
+    def shared_condition(self, name, evaluator):
+        
+        # Strategies with the same exchanges, tickers or percentage share one condition,
+        # so the rule graph evaluates it once per pass; evaluator builds it the first time
+        condition = self.conditions.get(name)
+        if condition is None:
+            condition = self.conditions[name] = self.create_condition(name, evaluator())
+        return condition
 
-        action_send_hedge_order = self.rulemsx.create_action("SendHedgeOrder", self.SendHedgeOrder(self.easymsx))
+    def build_rules(self):
         
+        log("Building Rules...")
+
+        demo_order_ruleset = self.rulemsx.create_ruleset("demoOrderRuleSet")
         demo_route_ruleset = self.rulemsx.create_ruleset("demoRouteRuleSet")
-        
-        rule_hedge_order_US = demo_route_ruleset.add_rule("HedgeOrderUS")
-        rule_hedge_order_US.add_rule_condition(cond_route_fill_occured)
-        rule_hedge_order_US.add_rule_condition(cond_route_exchange_US)
-        rule_hedge_order_US.add_rule_condition(cond_route_not_hedge)
-        rule_hedge_order_US.add_action(action_send_hedge_order)
+        # Both graphs exist even when no strategy routes, or none hedges
+        for ruleset in (demo_order_ruleset, demo_route_ruleset):
+            self.rule_graphs[ruleset.name] = RuleGraph(ruleset.name)
+        self.hedge_actions = []
+        routing = []
+        hedging = []
+
+        for strategy in self.strategies:
+            
+            exchanges = "/".join(strategy.exchanges)
+            tickers = "[" + ",".join(strategy.tickers) + "]"
+            
+            if strategy.route is not None:
+                # Orders an earlier routing strategy may cover are left to it
+                earlier = [other for other in routing if not strategy.disjoint(other)]
+                routing.append(strategy)
+
+                conditions = [
+                    self.shared_condition("OrderStatusIsNew", lambda: self.StringEqualityEvaluator("OrderStatus","NEW")),
+                    self.shared_condition("OrderNotHedge", lambda: self.StringInequalityEvaluator("OrderNotes","HEDGE")),
+                    self.shared_condition("OrderAmountTrigger" + repr(strategy.percentage), lambda: self.OrderAmountThresholdEvaluator(strategy.percentage))]
+                if len(strategy.exchanges) == 1:
+                    conditions.append(self.shared_condition("OrderExchange" + exchanges, lambda: self.StringEqualityEvaluator("Exchange", strategy.exchanges[0])))
+                elif len(strategy.exchanges) > 1:
+                    conditions.append(self.shared_condition("OrderExchange" + exchanges, lambda: self.StringMembershipEvaluator("Exchange", strategy.exchanges)))
+                if strategy.ticker_pattern is not None:
+                    conditions.append(self.shared_condition("OrderTicker" + tickers, lambda: self.TickerPatternEvaluator("OrderTicker", strategy)))
+                if len(earlier) > 0:
+                    conditions.append(self.shared_condition("OrderNotFor" + "+".join([other.name for other in earlier]), lambda: self.StrategyExclusionEvaluator(earlier)))
+                
+                action = self.create_action("NewOrder%s/OrderSendNewRoute%s" % (strategy.name, strategy.name), self.SendNewRoute(self.easymsx, strategy.route, self.scheduler, self.latency))
+                self.add_rule(demo_order_ruleset, "NewOrder" + strategy.name, conditions, action)
+            
+            if strategy.hedge_ticker is not None:
+                earlier = [other for other in hedging if not strategy.disjoint(other)]
+                hedging.append(strategy)
+                conditions = [
+                    self.shared_condition("RouteFillOccured", lambda: self.RouteFillOccured()),
+                    self.shared_condition("RouteNotHedge", lambda: self.StringInequalityEvaluator("RouteNotes","HEDGE"))]
+                if len(earlier) > 0:
+                    conditions.append(self.shared_condition("RouteOrderFor" + strategy.name, lambda: self.RouteOrderMatches(self.order_index, strategy, earlier)))
+                elif len(strategy.exchanges) > 0 or strategy.ticker_pattern is not None:
+                    conditions.append(self.shared_condition("RouteExchange" + exchanges + (tickers if strategy.ticker_pattern is not None else ""), lambda: self.RouteOrderMatches(self.order_index, strategy)))
+                
+                hedge_action = self.SendHedgeOrder(self.easymsx, strategy.hedge_template, strategy.hedge_ticker, self.order_index, self.scheduler, self.hedge_netting, self.sizer, self.latency, self.snapshot)
+                self.hedge_actions.append((strategy, hedge_action))
+                action = self.create_action("HedgeOrder%s/SendHedgeOrder%s" % (strategy.name, strategy.name), hedge_action)
+                self.add_rule(demo_route_ruleset, "HedgeOrder" + strategy.name, conditions, action)
+            
+            log("Strategy %s: exchanges %s, tickers %s, %s, %s", strategy.name, exchanges or "any", ",".join(strategy.tickers) or "any",
+                "no routing" if strategy.route is None else "route %s below %g x ADV" % (strategy.route.name, strategy.percentage),
+                "no hedging" if strategy.hedge_ticker is None else "hedge in %s" % strategy.hedge_ticker)
+
+        self.field_bindings["demoOrderRuleSet"] = self.compile_field_bindings(demo_order_ruleset, self.ORDER_DATAPOINTS)
+        self.field_bindings["demoRouteRuleSet"] = self.compile_field_bindings(demo_route_ruleset, self.ROUTE_DATAPOINTS)
 
         log("Rules built.")
 
 
     def process_notification(self,notification):
+        
+        started = time.perf_counter_ns()
+        try:
+            self.handle_notification(notification)
+        finally:
+            elapsed = time.perf_counter_ns() - started
+            key = (notification.category.name, notification.type.name)
+            with self.callback_lock:
+                self.notification_counts[key] = self.notification_counts.get(key, 0) + 1
+                self.callback_ns += elapsed
+                self.callback_count += 1
+                if elapsed > self.callback_max_ns:
+                    self.callback_max_ns = elapsed
+
+    def handle_notification(self,notification):
+
+        if self.recorder is not None:
+            if notification.category == EasyMSXNotification.NotificationCategory.ORDER:
+                self.recorder.record(notification, self.ORDER_FIELDS, ["EMSX_SEQUENCE"])
+            elif notification.category == EasyMSXNotification.NotificationCategory.ROUTE:
+                self.recorder.record(notification, self.ROUTE_FIELDS, ["EMSX_SEQUENCE", "EMSX_ROUTE_ID"])
+        
+        if notification.type == EasyMSXNotification.NotificationType.INITIALPAINT:
+            self.last_paint = time.monotonic()
+        elif not self.initial_paint_flushed.is_set():
+            # The first notification after the initial paint marks its end
+            self.flush_pending_orders()
 
         if notification.category == EasyMSXNotification.NotificationCategory.ORDER:
-            if notification.type == EasyMSXNotification.NotificationType.NEW or notification.type == EasyMSXNotification.NotificationType.INITIALPAINT: 
-                log("EasyMSX Notification ORDER -> NEW/INIT_PAINT: " + notification.source.field("EMSX_SEQUENCE").value())
-                self.parse_order(notification.source)
+            if notification.type == EasyMSXNotification.NotificationType.UPDATE:
+                self.order_index.update(notification.source, notification.field_changes)
+            elif notification.type == EasyMSXNotification.NotificationType.DELETE:
+                self.order_index.remove(int(notification.source.field("EMSX_SEQUENCE").value()))
+            elif notification.type == EasyMSXNotification.NotificationType.NEW or notification.type == EasyMSXNotification.NotificationType.INITIALPAINT:
+                self.order_index.add(notification.source)
+            
+            if notification.type == EasyMSXNotification.NotificationType.INITIALPAINT and self.hold_initial_paint(notification.source):
+                log("EasyMSX Notification ORDER -> INIT_PAINT (deferred): %s", notification.source.field("EMSX_SEQUENCE").value(), level=logging.DEBUG)
+            elif notification.type == EasyMSXNotification.NotificationType.NEW or notification.type == EasyMSXNotification.NotificationType.INITIALPAINT: 
+                log("EasyMSX Notification ORDER -> NEW/INIT_PAINT: %s", notification.source.field("EMSX_SEQUENCE").value())
+                self.track_order(notification.source)
         
         if notification.category == EasyMSXNotification.NotificationCategory.ROUTE:
             if notification.type == EasyMSXNotification.NotificationType.NEW or notification.type == EasyMSXNotification.NotificationType.INITIALPAINT: 
-                log("EasyMSX Notification ROUTE -> NEW/INIT_PAINT: " + notification.source.field("EMSX_SEQUENCE").value() + "/" + notification.source.field("EMSX_ROUTE_ID").value())
-                self.parse_route(notification.source)
+                log("EasyMSX Notification ROUTE -> NEW/INIT_PAINT: %s/%s", notification.source.field("EMSX_SEQUENCE").value(), notification.source.field("EMSX_ROUTE_ID").value())
+                self.track_route(notification.source)
+        
+        if notification.type == EasyMSXNotification.NotificationType.UPDATE:
+            self.apply_update(notification)
+        
+        if notification.type == EasyMSXNotification.NotificationType.UPDATE or notification.type == EasyMSXNotification.NotificationType.DELETE:
+            self.check_terminal(notification)
             
+    def rule_graph(self, ruleset_name):
+        
+        if self.options.rule_engine != "graph":
+            return None
+        return self.rule_graphs[ruleset_name]
+
+    def execute(self, ruleset_name, binding, status):
+        
+        # An order or route already in a terminal status gets one pass of the
+        # ruleset's RuleGraph (e.g. to hedge a route filled before it was seen) and is
+        # retired, rather than being attached to RuleMSX for good
+        log("Executing Ruleset with DataSet %s", binding.dataset.name, level=logging.DEBUG)
+        if status in self.TERMINAL_STATUSES:
+            self.rule_graphs[ruleset_name].evaluate(binding.dataset)
+            self.datasets.retire(binding.dataset.name)
+        elif binding.graph is None:
+            self.rulemsx.rulesets[ruleset_name].execute(binding.dataset)
+            binding.attached = True
+        else:
+            binding.graph.evaluate(binding.dataset)
+
+    def dataset_name(self, notification):
+        
+        if notification.category == EasyMSXNotification.NotificationCategory.ORDER:
+            return "DS_OR_" + notification.source.field("EMSX_SEQUENCE").value()
+        return "DS_RT_" + notification.source.field("EMSX_SEQUENCE").value() + "." + notification.source.field("EMSX_ROUTE_ID").value()
+
+    def apply_update(self, notification):
+        
+        name = self.dataset_name(notification)
+        binding = self.datasets.get(name)
+        if binding is None:
+            if name in self.stubs:
+                self.materialize(name, notification)
+            return
+        
+        if LOGGER.enabled(logging.DEBUG):
+            log("Update for dataset: %s", binding.dataset.name, level=logging.DEBUG)
+            for fc in notification.field_changes:
+                log("    >> %s: %s / %s", fc.field.name(), fc.old_value, fc.new_value, level=logging.DEBUG)
+        
+        binding.apply(notification.field_changes)
+        
+    def check_terminal(self, notification):
+        
+        status = notification.source.field("EMSX_STATUS").value()
+        if notification.type != EasyMSXNotification.NotificationType.DELETE and not status in self.TERMINAL_STATUSES:
+            return
+        
+        name = self.dataset_name(notification)
+        self.stubs.discard(name)
+        self.datasets.retire(name)
+
+    def hold_initial_paint(self, o):
+        
+        # Initial paint orders are held back until the paint has ended, so their
+        # reference data can be requested in bulk; False once it has
+        with self.pending_lock:
+            if self.initial_paint_done:
+                return False
+            self.pending_orders.append(o)
+            return True
+
+    def wait_for_initial_paint(self):
+        
+        # EasyMSX does not pass on the end of the initial paint, and start() may return
+        # before the paint has been delivered. The paint has ended at the first other
+        # notification (see handle_notification), or once no initial paint
+        # notification has arrived for --initial-paint-idle seconds.
+        while not self.initial_paint_flushed.is_set():
+            idle = self.last_paint + self.options.initial_paint_idle - time.monotonic()
+            if idle <= 0:
+                self.flush_pending_orders()
+            else:
+                self.initial_paint_flushed.wait(idle)
+
+    def flush_pending_orders(self):
+        
+        # Runs once, in whichever thread sees the end of the initial paint first; the
+        # other waits here until the held back orders have their datasets
+        with self.flush_lock:
+            if self.initial_paint_flushed.is_set():
+                return
+            try:
+                self.process_initial_paint()
+            finally:
+                self.initial_paint_flushed.set()
+
+    def process_initial_paint(self):
+        
+        with self.pending_lock:
+            self.initial_paint_done = True
+            pending = self.pending_orders
+            self.pending_orders = []
+        
+        if len(pending) == 0:
+            return
+        
+        log("Processing %d deferred initial paint orders", len(pending))
+        self.prefetch([o.field("EMSX_TICKER").value() for o in pending])
+        
+        if not self.has_rules("demoOrderRuleSet"):
+            return
+        
+        if not (self.options.screen_initial_paint or self.options.lazy_datasets):
+            for o in pending:
+                self.parse_order(o)
+            return
+        
+        started = time.perf_counter()
+        triggers = self.screen.screen(pending)
+        for o, trigger in zip(pending, triggers):
+            if trigger:
+                self.parse_order(o)
+            else:
+                self.defer("DS_OR_" + o.field("EMSX_SEQUENCE").value(), o.field("EMSX_STATUS").value())
+        built = triggers.count(True)
+        log("Screened %d initial paint orders in %.3fs: %d datasets built, %d deferred", len(pending), time.perf_counter() - started, built, len(pending) - built)
+    
+    def prefetch(self, tickers):
+        
+        # Requests the reference data the order rules read in bulk; with beta sizing,
+        # beta and prices come in the same requests, then the sizer keeps them fresh
+        if self.sizer is None:
+            self.refdata.prefetch(tickers, self.ORDER_REFDATA_FIELDS)
+        else:
+            self.refdata.prefetch(tickers + self.hedge_tickers, self.ORDER_REFDATA_FIELDS + self.sizer.fields)
+            self.sizer.track(tickers + self.hedge_tickers)
+
+    def defer(self, name, status):
+        
+        # Orders and routes already filled, cancelled or expired are not tracked at all
+        if not status in self.TERMINAL_STATUSES:
+            self.stubs.add(name)
+
+    def has_rules(self, ruleset_name):
+        
+        # A config may leave out every route or every hedge, leaving a ruleset empty;
+        # its orders or routes then need no dataset at all
+        return len(self.rule_graphs[ruleset_name].rules) > 0
+
+    def track_order(self, o):
         
+        # All the reference data of a new security comes in one request. In lazy mode a
+        # new order only gets a dataset if the order rules would fire on it now.
+        self.prefetch([o.field("EMSX_TICKER").value()])
+        if not self.has_rules("demoOrderRuleSet"):
+            return
+        if self.options.lazy_datasets and not self.screen.screen([o])[0]:
+            self.defer("DS_OR_" + o.field("EMSX_SEQUENCE").value(), o.field("EMSX_STATUS").value())
+            return
+        self.parse_order(o)
+
+    def track_route(self, r):
+        
+        if not self.has_rules("demoRouteRuleSet"):
+            return
+        
+        # With a snapshot, a route's fill delta is taken from the filled quantity last seen before a restart
+        filled_before = None
+        if self.snapshot is not None:
+            filled_before = self.snapshot.last_filled(to_int(r.field("EMSX_SEQUENCE").value()), to_int(r.field("EMSX_ROUTE_ID").value()))
+        
+        if not self.options.lazy_datasets:
+            self.parse_route(r, filled_before)
+            return
+        
+        name = "DS_RT_" + r.field("EMSX_SEQUENCE").value() + "." + r.field("EMSX_ROUTE_ID").value()
+        status = r.field("EMSX_STATUS").value()
+        if not self.route_triggers(r, filled_before):
+            self.defer(name, status)
+            return
+        
+        self.parse_route(r, filled_before)
+
+    def route_triggers(self, r, filled_before):
+        
+        # The conditions every HedgeOrder rule has, checked on the route itself: filled
+        # more than filled_before, not a hedge route, and an order a strategy hedges
+        notes = r.field("EMSX_NOTES").value()
+        if notes is not None and notes.startswith("HEDGE"):
+            return False
+        if (to_int(r.field("EMSX_FILLED").value()) or 0) <= (filled_before or 0):
+            return False
+        o = self.order_index.get(to_int(r.field("EMSX_SEQUENCE").value()))
+        return o is not None and any([strategy.matches(o.exchange, o.ticker) for strategy, hedge_action in self.hedge_actions])
+
+    def materialize(self, name, notification):
+        
+        # A deferred order or route gets its dataset once a change can trigger a rule:
+        # an order when a field the order rules wake on changes and it passes the
+        # screen, a route when it is filled. The dataset is built from the updated
+        # order or route and evaluated once.
+        source = notification.source
+        if notification.category == EasyMSXNotification.NotificationCategory.ORDER:
+            fields = self.field_bindings["demoOrderRuleSet"]
+            for fc in notification.field_changes:
+                binding = fields.get(fc.field.name())
+                if binding is not None and binding[1] is not None:
+                    if self.screen.screen([source])[0]:
+                        self.stubs.discard(name)
+                        self.parse_order(source)
+                    return
+            return
+        
+        for fc in notification.field_changes:
+            if fc.field.name() == "EMSX_FILLED":
+                filled_before = to_int(fc.old_value)
+                if self.route_triggers(source, filled_before):
+                    self.stubs.discard(name)
+                    self.parse_route(source, filled_before)
+                return
+
+    def resume_hedges(self):
+        
+        # Fills that were handed to hedging before a restart but never confirmed hedged
+        if self.snapshot is None:
+            return
+        
+        for ord_no, quantity in self.snapshot.unhedged.items():
+            o = self.order_index.get(ord_no)
+            for strategy, hedge_action in self.hedge_actions:
+                if o is not None and strategy.matches(o.exchange, o.ticker):
+                    break
+            else:
+                log("No strategy hedges order %d - %d filled shares not hedged", ord_no, quantity, level=logging.ERROR)
+                continue
+            log("Resuming %s hedge for %d filled shares of order %d", strategy.name, quantity, ord_no, level=logging.WARNING)
+            hedge_action.hedge(strategy.hedge_ticker, ord_no, quantity, time.perf_counter_ns())
+
     def parse_order(self,o):
         
-        log("Parse Order: " + o.field("EMSX_SEQUENCE").value())
+        log("Parse Order: %s", o.field("EMSX_SEQUENCE").value(), level=logging.DEBUG)
 
         new_dataset = self.rulemsx.create_dataset("DS_OR_" + o.field("EMSX_SEQUENCE").value())
 
-        new_dataset.add_datapoint("OrderStatus", self.EMSXFieldDataPointSource(o.field("EMSX_STATUS")))
-        new_dataset.add_datapoint("OrderTicker", self.EMSXFieldDataPointSource(o.field("EMSX_TICKER")))
-        new_dataset.add_datapoint("OrderNumber", self.EMSXFieldDataPointSource(o.field("EMSX_SEQUENCE")))
-        new_dataset.add_datapoint("OrderAmount", self.EMSXFieldDataPointSource(o.field("EMSX_AMOUNT")))
-        new_dataset.add_datapoint("OrderNotes", self.EMSXFieldDataPointSource(o.field("EMSX_NOTES")))
-        new_dataset.add_datapoint("TriggerThreshold", self.ConstDataPointSource(self.options.percentage))
-        new_dataset.add_datapoint("20DayAvgVol", self.GetRefDataField(self.easymkt, o.field("EMSX_TICKER").value(),"VOLUME_AVG_20D"))
-        new_dataset.add_datapoint("Exchange", self.GetRefDataField(self.easymkt, o.field("EMSX_TICKER").value(),"EXCH_CODE"))
+        trace = LatencyTrace()
+        new_dataset.add_datapoint("Trace", self.GenericValueDataPointSource(trace))
+        for datapoint_name, field_name, parse in self.ORDER_DATAPOINTS:
+            new_dataset.add_datapoint(datapoint_name, self.EMSXFieldDataPointSource(o.field(field_name).value(), parse))
+        avg_vol = self.GetRefDataField(self.refdata, o.field("EMSX_TICKER").value(),"VOLUME_AVG_20D")
+        new_dataset.add_datapoint("20DayAvgVol", avg_vol)
+        new_dataset.add_datapoint("TriggerVolume", self.TriggerVolumeDataPointSource(avg_vol))
+        new_dataset.add_datapoint("Exchange", self.GetRefDataField(self.refdata, o.field("EMSX_TICKER").value(),"EXCH_CODE"))
 
-        log("Executing Ruleset with DataSet " + new_dataset.name)
-        self.rulemsx.rulesets["demoOrderRuleSet"].execute(new_dataset)
+        binding = DataSetBinding(new_dataset, self.field_bindings["demoOrderRuleSet"], trace, self.latency, self.rule_graph("demoOrderRuleSet"))
+        self.datasets.add(binding)
+        self.execute("demoOrderRuleSet", binding, o.field("EMSX_STATUS").value())
 
 
-    def parse_route(self,r):
+    def parse_route(self,r,filled_before=None):
         
-        log("Parse Route: " + r.field("EMSX_SEQUENCE").value() + "." + r.field("EMSX_ROUTE_ID").value())
+        # filled_before is the filled quantity the first fill is measured from (none seen if None)
+        log("Parse Route: %s.%s", r.field("EMSX_SEQUENCE").value(), r.field("EMSX_ROUTE_ID").value(), level=logging.DEBUG)
         
         new_dataset = self.rulemsx.create_dataset("DS_RT_" + r.field("EMSX_SEQUENCE").value() + "." + r.field("EMSX_ROUTE_ID").value())
     
-        new_dataset.add_datapoint("RouteStatus", self.EMSXFieldDataPointSource(r.field("EMSX_STATUS")))
-        new_dataset.add_datapoint("RouteOrderNumber", self.EMSXFieldDataPointSource(r.field("EMSX_SEQUENCE")))
-        new_dataset.add_datapoint("RouteID", self.EMSXFieldDataPointSource(r.field("EMSX_ROUTE_ID")))
-        new_dataset.add_datapoint("RouteFilled", self.EMSXFieldDataPointSource(r.field("EMSX_FILLED")))
-        new_dataset.add_datapoint("RouteAmount", self.EMSXFieldDataPointSource(r.field("EMSX_AMOUNT")))
-        new_dataset.add_datapoint("RouteLastShares", self.EMSXFieldDataPointSource(r.field("EMSX_LAST_SHARES")))
-        new_dataset.add_datapoint("HedgeTicker", self.ConstDataPointSource(self.options.ticker))
+        trace = LatencyTrace()
+        new_dataset.add_datapoint("Trace", self.GenericValueDataPointSource(trace))
+        for datapoint_name, field_name, parse in self.ROUTE_DATAPOINTS:
+            new_dataset.add_datapoint(datapoint_name, self.EMSXFieldDataPointSource(r.field(field_name).value(), parse, filled_before if field_name == "EMSX_FILLED" else None))
         new_dataset.add_datapoint("FillAmount", self.GenericValueDataPointSource(0))
-        new_dataset.add_datapoint("HedgeAmount", self.GenericValueDataPointSource(1))
-        new_dataset.add_datapoint("RouteNotes", self.EMSXFieldDataPointSource(r.field("EMSX_NOTES")))
         
-        log("Executing Ruleset with DataSet " + new_dataset.name)
-        self.rulemsx.rulesets["demoRouteRuleSet"].execute(new_dataset)
+        binding = DataSetBinding(new_dataset, self.field_bindings["demoRouteRuleSet"], trace, self.latency, self.rule_graph("demoRouteRuleSet"))
+        self.datasets.add(binding)
+        self.execute("demoRouteRuleSet", binding, r.field("EMSX_STATUS").value())
     
 if __name__ == '__main__':
     
     options=parseCommandLine()
+    
+    LOGGER.configure(logging.getLevelName(options.log_level), not options.no_console, options.log_file)
 
     RMSXSimpleStockHedgeDemo = RMSXSimpleStockHedgeDemo(options);
     
@@ -496,7 +3029,8 @@ if __name__ == '__main__':
 
     log("Terminating...")
 
-    RMSXSimpleStockHedgeDemo.rulemsx.stop()
+    RMSXSimpleStockHedgeDemo.stop()
+    LOGGER.stop()
     
     quit()
     
\ No newline at end of file
@@ -0,0 +1,621 @@
+# RMSXSimpleStockHedgeReplay.py
+#
+# Runs RMSXSimpleStockHedgeDemo against local stand-ins for EasyMSX and EasyMKT.
+# A stream of order, route and fill notifications (recorded with
+# RMSXSimpleStockHedgeDemo.py --record, or generated here) is replayed through the
+# demo, and throughput, fill to hedge latency and memory are reported.
+#
+# Options after -- are passed to RMSXSimpleStockHedgeDemo, e.g.
+#   python RMSXSimpleStockHedgeReplay.py -n 1000 10000 -- --hedge-window 0.5
+#
+# --self-test replays a synthetic stream through every rule engine and dataset
+# mode, a restart from a snapshot and a sharded run, and checks the requests sent.
+
+import argparse
+from collections import deque
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import RMSXSimpleStockHedgeDemo as demo
+from easymsx.notification import Notification as EasyMSXNotification
+
+DEFAULT_DEMO_ARGS = ["-p", "0.1", "-t", "SPY US Equity", "--hedge-window", "0", "--initial-paint-idle", "0", "--memory-report", "0", "--no-console"]
+
+def parseCommandLine():
+
+    parser = argparse.ArgumentParser(description="Bloomberg - RMSX Example - RMSXSimpleStockHedgeDemo replay and benchmark")
+
+    parser.add_argument('-e', '--events', help='JSON lines event file recorded with RMSXSimpleStockHedgeDemo.py --record (default is a synthetic stream)', action='store', default=None)
+    parser.add_argument('-n', '--orders', help='Synthetic blotter sizes to benchmark', action='store', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--fills', help='Fills per synthetic route', action='store', type=int, default=5)
+    parser.add_argument('--tickers', help='Number of distinct tickers in the synthetic stream', action='store', type=int, default=500)
+    parser.add_argument('--rate', help='Live notifications per second to replay (0 replays as fast as possible)', action='store', type=float, default=0)
+    parser.add_argument('--latency-ms', help='Simulated EMSX response time per request', action='store', type=float, default=0)
+    parser.add_argument('--error-rate', help='Fraction of EMSX requests answered with ErrorInfo', action='store', type=float, default=0)
+    parser.add_argument('--seed', help='Random seed for the synthetic stream and error injection', action='store', type=int, default=1)
+    parser.add_argument('--tracemalloc', help='Also report peak Python heap usage (slows the run down)', action='store_true')
+    parser.add_argument('--save', help='Write the synthetic stream for the first size to this file and exit', action='store', default=None)
+    parser.add_argument('--self-test', help='Check engine, dataset mode, snapshot restart and shard parity on a synthetic stream and exit (options after -- are ignored)', action='store_true')
+    parser.add_argument('demo_args', help='Options passed to RMSXSimpleStockHedgeDemo (after --)', nargs=argparse.REMAINDER)
+
+    options = parser.parse_args()
+
+    if len(options.demo_args) > 0 and options.demo_args[0] == "--":
+        options.demo_args = options.demo_args[1:]
+
+    return options
+
+
+class ReplayField:
+
+    __slots__ = ("field_name", "current")
+
+    def __init__(self, name, value):
+        self.field_name = name
+        self.current = value
+
+    def name(self):
+        return self.field_name
+
+    def value(self):
+        return self.current
+
+
+class ReplayFieldChange:
+
+    __slots__ = ("field", "old_value", "new_value")
+
+    def __init__(self, field, old_value, new_value):
+        self.field = field
+        self.old_value = old_value
+        self.new_value = new_value
+
+
+class ReplayNotification:
+
+    __slots__ = ("category", "type", "source", "field_changes")
+
+    def __init__(self, category, notification_type, source, field_changes):
+        self.category = category
+        self.type = notification_type
+        self.source = source
+        self.field_changes = field_changes
+
+
+class ReplayRecord:
+
+    # An order or route; fields that were not in the stream read as empty strings
+
+    def __init__(self, values):
+        self.fields = {}
+        for name, value in values.items():
+            self.fields[name] = ReplayField(name, value)
+
+    def field(self, name):
+        f = self.fields.get(name)
+        if f is None:
+            f = self.fields[name] = ReplayField(name, "")
+        return f
+
+
+class ReplayCollection:
+
+    def __init__(self, category):
+        self.category = category
+        self.handlers = []
+        self.records = {}
+
+    def add_notification_handler(self, handler):
+        self.handlers.append(handler)
+
+    def get_by_sequence_no(self, seq):
+        return self.records.get(int(seq))
+
+    def notify(self, notification_type, record, field_changes):
+
+        notification = ReplayNotification(self.category, notification_type, record, field_changes)
+        for handler in self.handlers:
+            handler(notification)
+
+
+class ReplayElement:
+
+    # Read-only view over nested dicts/lists with the blpapi Element methods the demo uses
+
+    def __init__(self, data):
+        self.data = data
+
+    def getElement(self, name):
+        return ReplayElement(self.data[name])
+
+    def hasElement(self, name):
+        return name in self.data
+
+    def numValues(self):
+        return len(self.data)
+
+    def getValue(self, index=None):
+        if index is None:
+            return self.data
+        return ReplayElement(self.data[index])
+
+    def getElementAsString(self, name):
+        return str(self.data[name])
+
+    def getElementAsInteger(self, name):
+        return int(self.data[name])
+
+
+class ReplayRequestElement:
+
+    def __init__(self, data):
+        self.data = data
+
+    def setElement(self, name, value):
+        self.data[name] = value
+
+    def getElement(self, name):
+        child = self.data.get(name)
+        if child is None:
+            child = self.data[name] = {}
+        return ReplayRequestElement(child)
+
+    def appendElement(self):
+        # The first appendElement turns an empty element into an array
+        if not isinstance(self.data.get("values"), list):
+            self.data["values"] = []
+        child = {}
+        self.data["values"].append(child)
+        return ReplayRequestElement(child)
+
+
+class ReplayRequest:
+
+    def __init__(self, name):
+        self.name = name
+        self.values = {}
+
+    def set(self, name, value):
+        self.values[name] = value
+
+    def append(self, name, value):
+        self.values.setdefault(name, []).append(value)
+
+    def getElement(self, name):
+        return ReplayRequestElement(self.values.setdefault(name, {}))
+
+
+class ReplayMessage(ReplayElement):
+
+    def __init__(self, message_type, data):
+        super().__init__(data)
+        self.message_type = message_type
+
+    def messageType(self):
+        return self.message_type
+
+
+class ReplayEasyMKT:
+
+    def __init__(self, refdata):
+        self.refdata = refdata
+        self.requests = 0
+
+    def create_request(self, name):
+        return ReplayRequest(name)
+
+    def send_request(self, req):
+
+        self.requests += 1
+        security_data = []
+        for ticker in req.values.get("securities", []):
+            field_data = {}
+            for field in req.values.get("fields", []):
+                if (ticker, field) in self.refdata:
+                    field_data[field] = self.refdata[(ticker, field)]
+            security_data.append({"security": ticker, "fieldData": field_data})
+
+        return ReplayMessage("ReferenceDataResponse", {"securityData": security_data})
+
+
+class ReplayEasyMSX:
+
+    # Order and route notifications are delivered synchronously by apply(), the same
+    # way EasyMSX calls the handlers from its event thread. Requests are answered
+    # after latency seconds, a fraction error_rate of them with ErrorInfo.
+
+    def __init__(self, initial_paint, latency, error_rate, seed):
+
+        self.orders = ReplayCollection(EasyMSXNotification.NotificationCategory.ORDER)
+        self.routes = ReplayCollection(EasyMSXNotification.NotificationCategory.ROUTE)
+        self.initial_paint = initial_paint
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.sent = []
+        self.notifications = 0
+
+    def create_request(self, name):
+        return ReplayRequest(name)
+
+    def send_request(self, req):
+
+        with self.lock:
+            self.sent.append((time.perf_counter(), req))
+            failed = self.error_rate > 0 and self.random.random() < self.error_rate
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        if failed:
+            return ReplayMessage("ErrorInfo", {"ERROR_CODE": 99999, "ERROR_MESSAGE": "Simulated failure"})
+        return ReplayMessage(req.name, {"EMSX_SEQUENCE": 0, "MESSAGE": "Simulated success"})
+
+    def start(self):
+        for event in self.initial_paint:
+            self.apply(event)
+
+    def apply(self, event):
+
+        fields = event["fields"]
+        notification_type = EasyMSXNotification.NotificationType[event["type"]]
+
+        if event["category"] == "ORDER":
+            collection = self.orders
+            key = int(fields["EMSX_SEQUENCE"])
+        else:
+            collection = self.routes
+            key = (int(fields["EMSX_SEQUENCE"]), int(fields["EMSX_ROUTE_ID"]))
+
+        record = collection.records.get(key)
+
+        if record is None or notification_type != EasyMSXNotification.NotificationType.UPDATE:
+            if record is None:
+                record = collection.records[key] = ReplayRecord(fields)
+            collection.notify(notification_type, record, [])
+            if notification_type == EasyMSXNotification.NotificationType.DELETE:
+                del collection.records[key]
+        else:
+            changes = []
+            for name, value in fields.items():
+                f = record.field(name)
+                if f.current != value:
+                    changes.append(ReplayFieldChange(f, f.current, value))
+                    f.current = value
+            collection.notify(notification_type, record, changes)
+
+        self.notifications += 1
+
+    def wait_until_quiet(self, idle, timeout):
+
+        deadline = time.monotonic() + timeout
+        count = -1
+        while time.monotonic() < deadline:
+            with self.lock:
+                latest = len(self.sent)
+            if latest == count:
+                return True
+            count = latest
+            time.sleep(idle)
+        return False
+
+
+def synthetic_stream(orders, fills, tickers, seed):
+
+    rnd = random.Random(seed)
+    events = []
+
+    names = []
+    for i in range(tickers):
+        exchange = "US" if i % 2 == 0 else "LN"
+        ticker = "T%04d %s Equity" % (i, exchange)
+        names.append((ticker, exchange))
+        events.append({"category": "REFDATA", "ticker": ticker, "fields": {"EXCH_CODE": exchange, "VOLUME_AVG_20D": float(rnd.randrange(100000, 10000000)), "PX_LAST": round(rnd.uniform(5, 500), 2), "EQY_BETA": round(rnd.uniform(0.5, 1.8), 3)}})
+    events.append({"category": "REFDATA", "ticker": "SPY US Equity", "fields": {"PX_LAST": 450.0, "EQY_BETA": 1.0}})
+
+    routes = []
+    for seq in range(1, orders + 1):
+        ticker, exchange = rnd.choice(names)
+        amount = rnd.randrange(100, 10000, 100)
+        status = "NEW" if rnd.random() < 0.2 else "WORKING"
+        notes = "HEDGE:1" if rnd.random() < 0.05 else ""
+        events.append({"category": "ORDER", "type": "INITIALPAINT", "fields": {"EMSX_SEQUENCE": str(seq), "EMSX_STATUS": status, "EMSX_TICKER": ticker, "EMSX_AMOUNT": str(amount), "EMSX_NOTES": notes, "EMSX_EXCHANGE": exchange, "EMSX_SIDE": rnd.choice(["BUY", "SELL"])}})
+
+        if status == "WORKING":
+            events.append({"category": "ROUTE", "type": "INITIALPAINT", "fields": {"EMSX_SEQUENCE": str(seq), "EMSX_ROUTE_ID": "1", "EMSX_STATUS": "WORKING", "EMSX_FILLED": "0", "EMSX_AMOUNT": str(amount), "EMSX_LAST_SHARES": "0", "EMSX_NOTES": notes}})
+
+            updates = []
+            filled = 0
+            for i in range(fills):
+                last = amount - filled if i == fills - 1 else amount // fills
+                filled += last
+                update = {"EMSX_SEQUENCE": str(seq), "EMSX_ROUTE_ID": "1", "EMSX_FILLED": str(filled), "EMSX_LAST_SHARES": str(last)}
+                update["EMSX_STATUS"] = "FILLED" if filled >= amount else "PARTFILL"
+                updates.append({"category": "ROUTE", "type": "UPDATE", "fields": update})
+            routes.append(deque(updates))
+
+    # Interleave the fills of all routes while keeping each route's fills in order
+    while len(routes) > 0:
+        i = rnd.randrange(len(routes))
+        events.append(routes[i].popleft())
+        if len(routes[i]) == 0:
+            routes[i] = routes[-1]
+            routes.pop()
+
+    return events
+
+
+def load_events(path):
+
+    events = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) > 0:
+                events.append(json.loads(line))
+    return events
+
+
+def save_events(path, events):
+
+    with open(path, "w") as f:
+        for event in events:
+            f.write(json.dumps(event) + "\n")
+
+
+def percentile(ordered, p):
+
+    if len(ordered) == 0:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(p / 100.0 * len(ordered)))]
+
+
+def is_fill(event):
+    return event["category"] == "ROUTE" and event["type"] == "UPDATE" and "EMSX_FILLED" in event["fields"]
+
+
+def split_events(events):
+
+    # (reference data by (ticker, field), initial paint events, live events)
+    refdata = {}
+    initial_paint = []
+    live = []
+    for event in events:
+        if event["category"] == "REFDATA":
+            for field, value in event["fields"].items():
+                refdata[(event["ticker"], field)] = value
+        elif event["type"] == "INITIALPAINT":
+            initial_paint.append(event)
+        else:
+            live.append(event)
+    return refdata, initial_paint, live
+
+
+def run(events, options, demo_options):
+
+    refdata, initial_paint, live = split_events(events)
+
+    easymsx = ReplayEasyMSX(initial_paint, options.latency_ms / 1000.0, options.error_rate, options.seed)
+    easymkt = ReplayEasyMKT(refdata)
+
+    if options.tracemalloc:
+        tracemalloc.start()
+    rss_before = demo.resident_memory()
+
+    started = time.perf_counter()
+    rmsx = demo.RMSXSimpleStockHedgeDemo(demo_options, easymsx, easymkt)
+    startup = time.perf_counter() - started
+
+    fill_times = {}
+    interval = 1.0 / options.rate if options.rate > 0 else 0
+    started = time.perf_counter()
+    for i, event in enumerate(live):
+        if interval > 0:
+            delay = started + i * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if is_fill(event):
+            fill_times.setdefault(int(event["fields"]["EMSX_SEQUENCE"]), deque()).append(time.perf_counter())
+        easymsx.apply(event)
+    replay = time.perf_counter() - started
+
+    live_datasets = len(rmsx.datasets.datasets)
+    rss_after = demo.resident_memory()
+    peak = None
+    if options.tracemalloc:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    easymsx.wait_until_quiet(0.5, 60)
+    rmsx.stop()
+
+    latencies = []
+    hedges = 0
+    routes = 0
+    for sent, req in easymsx.sent:
+        if req.name == "RouteEx":
+            routes += 1
+        elif req.name == "CreateOrderAndRouteEx":
+            hedges += 1
+            notes = str(req.values.get("EMSX_NOTES", ""))
+            pending = fill_times.get(int(notes[6:].split("+")[0]))
+            while pending and pending[0] <= sent:
+                latencies.append(sent - pending.popleft())
+    latencies.sort()
+
+    fills = sum([1 for event in live if is_fill(event)])
+    print("  initial paint      : %d notifications in %.3fs (%.0f/s), %d refdata requests" % (len(initial_paint), startup, len(initial_paint) / max(startup, 1e-9), easymkt.requests))
+    print("  live replay        : %d notifications (%d fills) in %.3fs (%.0f/s)" % (len(live), fills, replay, len(live) / max(replay, 1e-9)))
+    print("  requests sent      : %d RouteEx, %d CreateOrderAndRouteEx" % (routes, hedges))
+    print("  fill->hedge latency: p50 %.3fms  p90 %.3fms  p99 %.3fms  max %.3fms  (%d samples)" % (percentile(latencies, 50) * 1000, percentile(latencies, 90) * 1000, percentile(latencies, 99) * 1000, percentile(latencies, 100) * 1000, len(latencies)))
+    if rss_before is not None and rss_after is not None:
+        print("  memory             : RSS +%.1f MB, %d live datasets (%.2f KB each)" % ((rss_after - rss_before) / 1048576.0, live_datasets, (rss_after - rss_before) / 1024.0 / max(live_datasets, 1)))
+    if peak is not None:
+        print("  python heap peak   : %.1f MB" % (peak / 1048576.0))
+
+
+# A percentage at which the synthetic orders fall on both sides of the threshold
+SELF_TEST_ARGS = ["-p", "0.002"]
+
+# Engines and dataset modes that must all send the same requests
+SELF_TEST_MODES = [
+    [],
+    ["--rule-engine", "graph"],
+    ["--lazy-datasets"],
+    ["--screen-initial-paint"],
+    ["--rule-engine", "graph", "--lazy-datasets"]]
+
+
+def sent_requests(easymsx):
+
+    # The order numbers routed, and the hedge amount sent per (ticker, side)
+    routed = sorted([int(req.values["EMSX_SEQUENCE"]) for sent, req in easymsx.sent if req.name == "RouteEx"])
+    hedged = {}
+    for sent, req in easymsx.sent:
+        if req.name == "CreateOrderAndRouteEx":
+            key = (req.values["EMSX_TICKER"], req.values["EMSX_SIDE"])
+            hedged[key] = hedged.get(key, 0) + int(req.values["EMSX_AMOUNT"])
+    return routed, hedged
+
+
+def expected_requests(events, percentage, hedge_ticker):
+
+    # What demo.DEFAULT_STRATEGIES call for on a synthetic stream, hedging shares one
+    # for one: a route for every new order that is not a hedge and is below
+    # percentage x 20 day average volume, and a hedge on the other side for every
+    # share filled on the routes of working US orders that are not hedges
+    avg_vol = {}
+    for event in events:
+        if event["category"] == "REFDATA":
+            avg_vol[event["ticker"]] = event["fields"].get("VOLUME_AVG_20D")
+
+    routed = []
+    hedged = {}
+    for event in events:
+        if event["category"] != "ORDER":
+            continue
+        fields = event["fields"]
+        if fields["EMSX_NOTES"].startswith("HEDGE"):
+            continue
+        if fields["EMSX_STATUS"] == "NEW" and int(fields["EMSX_AMOUNT"]) < percentage * avg_vol[fields["EMSX_TICKER"]]:
+            routed.append(int(fields["EMSX_SEQUENCE"]))
+        elif fields["EMSX_STATUS"] == "WORKING" and fields["EMSX_EXCHANGE"] == "US":
+            key = (hedge_ticker, "SELL" if fields["EMSX_SIDE"] == "BUY" else "BUY")
+            hedged[key] = hedged.get(key, 0) + int(fields["EMSX_AMOUNT"])
+    return sorted(routed), hedged
+
+
+def blotter_paint(easymsx):
+
+    # The orders and routes as they stand, as the initial paint of a restart
+    events = []
+    for collection, category in ((easymsx.orders, "ORDER"), (easymsx.routes, "ROUTE")):
+        for record in collection.records.values():
+            events.append({"category": category, "type": "INITIALPAINT", "fields": dict([(name, f.current) for name, f in record.fields.items()])})
+    return events
+
+
+def replay_requests(refdata, initial_paint, live, demo_args, shards=0, stop=True):
+
+    # Replays the events through a demo (sharded if shards > 0) and returns the
+    # requests it sent; without stop, the demo is abandoned as if it had crashed
+    easymsx = ReplayEasyMSX(initial_paint, 0, 0, 1)
+    easymkt = ReplayEasyMKT(refdata)
+    demo_options = demo.parseCommandLine(DEFAULT_DEMO_ARGS + SELF_TEST_ARGS + demo_args)
+    if shards > 0:
+        # Imported here, as RMSXSimpleStockHedgeShards imports this module
+        from RMSXSimpleStockHedgeShards import ShardedStockHedgeDemo
+        rmsx = ShardedStockHedgeDemo(demo_options, shards, easymsx, easymkt)
+    else:
+        rmsx = demo.RMSXSimpleStockHedgeDemo(demo_options, easymsx, easymkt)
+
+    for event in live:
+        easymsx.apply(event)
+    easymsx.wait_until_quiet(0.2, 60)
+    if stop:
+        rmsx.stop()
+    return sent_requests(easymsx), easymsx
+
+
+def self_test(options):
+
+    # Returns the number of failed checks
+    events = synthetic_stream(1000, options.fills, 100, options.seed)
+    refdata, initial_paint, live = split_events(events)
+    defaults = demo.parseCommandLine(DEFAULT_DEMO_ARGS + SELF_TEST_ARGS)
+    expected = expected_requests(events, float(defaults.percentage), defaults.ticker)
+    print("Self test: %d orders, %d routes expected, %d shares hedged expected" % (1000, len(expected[0]), sum(expected[1].values())))
+
+    checks = []
+    failed = []
+
+    def check(name, ok, detail):
+        print("  %-60s: %s" % (name, "ok" if ok else "FAILED - " + detail))
+        checks.append(name)
+        if not ok:
+            failed.append(name)
+
+    def describe(requests):
+        return "%d routes, hedged %s" % (len(requests[0]), sorted(requests[1].items()))
+
+    for mode in SELF_TEST_MODES:
+        sent, easymsx = replay_requests(refdata, initial_paint, live, mode)
+        check("parity %s" % (" ".join(mode) or "(default)"), sent == expected, "%s, expected %s" % (describe(sent), describe(expected)))
+
+    # Beta sizing has no independent expectation, so its modes are checked against each other
+    beta, easymsx = replay_requests(refdata, initial_paint, live, ["--hedge-sizing", "beta"])
+    for mode in SELF_TEST_MODES[1:]:
+        sent, easymsx = replay_requests(refdata, initial_paint, live, ["--hedge-sizing", "beta"] + mode)
+        check("parity --hedge-sizing beta %s" % " ".join(mode), sent == beta, "%s, expected %s" % (describe(sent), describe(beta)))
+
+    # The first run is abandoned half way, with every fill it saw still held back for
+    # netting; the restart must hedge all the fills once, a second restart none
+    directory = tempfile.mkdtemp(prefix="rmsx-self-test")
+    try:
+        snapshot = os.path.join(directory, "snapshot")
+        half = len(live) // 2
+        crashed, easymsx = replay_requests(refdata, initial_paint, live[:half], ["--snapshot", snapshot, "--hedge-window", "3600"], stop=False)
+        restarted, easymsx = replay_requests(refdata, blotter_paint(easymsx), live[half:], ["--snapshot", snapshot])
+        check("snapshot restart hedges every fill once", crashed[1] == {} and restarted[1] == expected[1], "hedged %s then %s, expected %s" % (sorted(crashed[1].items()), sorted(restarted[1].items()), sorted(expected[1].items())))
+        again, easymsx = replay_requests(refdata, blotter_paint(easymsx), [], ["--snapshot", snapshot])
+        check("second snapshot restart hedges nothing", again[1] == {}, "hedged %s" % sorted(again[1].items()))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    sent, easymsx = replay_requests(refdata, initial_paint, live, [], shards=2)
+    check("parity with 2 shards", sent == expected, "%s, expected %s" % (describe(sent), describe(expected)))
+
+    print("Self test %s: %d of %d checks failed" % ("failed" if failed else "passed", len(failed), len(checks)))
+    return len(failed)
+
+
+if __name__ == '__main__':
+
+    options = parseCommandLine()
+    demo_options = demo.parseCommandLine(DEFAULT_DEMO_ARGS + options.demo_args)
+    demo.LOGGER.configure(logging.getLevelName(demo_options.log_level), not demo_options.no_console, demo_options.log_file)
+
+    if options.self_test:
+        failed = self_test(options)
+        demo.LOGGER.stop()
+        sys.exit(1 if failed > 0 else 0)
+    elif options.events is not None:
+        print("Replaying %s" % (options.events))
+        run(load_events(options.events), options, demo_options)
+    elif options.save is not None:
+        save_events(options.save, synthetic_stream(options.orders[0], options.fills, options.tickers, options.seed))
+    else:
+        for orders in options.orders:
+            print("Synthetic blotter: %d orders, %d fills per route" % (orders, options.fills))
+            run(synthetic_stream(orders, options.fills, options.tickers, options.seed), options, demo_options)
+
+    demo.LOGGER.stop()
@@ -0,0 +1,387 @@
+# RMSXSimpleStockHedgeShards.py
+#
+# Runs the RMSXSimpleStockHedgeDemo rules in several worker processes. The parent
+# process owns the EasyMSX and EasyMKT sessions. It hashes EMSX_SEQUENCE to pick a
+# shard and forwards each order and route notification to that shard as a plain
+# event (the format written by RMSXSimpleStockHedgeDemo.py --record). Routes carry
+# the sequence number of their order, so an order, its routes and their fills
+# always land on the same shard.
+#
+# Each shard runs an unmodified RMSXSimpleStockHedgeDemo against local stand-ins
+# (see RMSXSimpleStockHedgeReplay.py). Its reference data lookups and EMSX requests
+# are sent back to the parent, which serves them from one shared reference data
+# cache and sends the requests on its own session.
+#
+# Options other than --shards are passed to RMSXSimpleStockHedgeDemo, e.g.
+#   python RMSXSimpleStockHedgeShards.py --shards 4 -p 0.1 -t "SPY US Equity"
+
+import argparse
+from concurrent.futures import Future, ThreadPoolExecutor
+import logging
+import multiprocessing
+import os
+import threading
+
+import RMSXSimpleStockHedgeDemo as demo
+from RMSXSimpleStockHedgeDemo import log
+from RMSXSimpleStockHedgeReplay import ReplayEasyMKT, ReplayEasyMSX, ReplayMessage
+from easymsx.easymsx import EasyMSX
+from easymsx.notification import Notification as EasyMSXNotification
+from easymkt.easymkt import EasyMKT
+
+# Sent to every shard once the parent's EasyMSX has delivered the initial paint
+PAINTED = "PAINTED"
+
+def parseCommandLine(args=None):
+
+    parser = argparse.ArgumentParser(description="Bloomberg - RMSX Example - RMSXSimpleStockHedgeDemo sharded across processes (other options are passed to RMSXSimpleStockHedgeDemo)")
+
+    parser.add_argument('-n', '--shards', help='Number of worker processes', action='store', type=int, default=os.cpu_count() or 1)
+
+    options, demo_args = parser.parse_known_args(args)
+
+    return options.shards, demo.parseCommandLine(demo_args)
+
+
+def shard_options(options, shard, shards):
+
+    # Only the parent records notifications; per-shard files get the shard number
+    # appended, each shard serves metrics on the next port up, and the send rate
+    # limit is split between the shards. The shard count is kept in each snapshot,
+    # which then refuses a restart with a different --shards.
+    options = argparse.Namespace(**vars(options))
+    options.record = None
+    options.shard = (shard, shards)
+    options.send_rate = options.send_rate / shards
+    if options.log_file is not None:
+        options.log_file = "%s.%d" % (options.log_file, shard)
+    if options.latency_file is not None:
+        options.latency_file = "%s.%d" % (options.latency_file, shard)
+    if options.snapshot is not None:
+        options.snapshot = "%s.%d" % (options.snapshot, shard)
+    if options.metrics_port > 0:
+        options.metrics_port = options.metrics_port + shard
+    return options
+
+
+def apply_request(req, values):
+
+    # Rebuilds a request recorded by a ReplayRequest (see ReplayRequestElement) on a real one
+    for name, value in values.items():
+        if isinstance(value, dict):
+            apply_element(req.getElement(name), value)
+        elif isinstance(value, list):
+            for item in value:
+                req.append(name, item)
+        else:
+            req.set(name, value)
+
+
+def apply_element(element, data):
+
+    for name, value in data.items():
+        if name == "values" and isinstance(value, list):
+            for child in value:
+                apply_element(element.appendElement(), child)
+        elif isinstance(value, dict):
+            apply_element(element.getElement(name), value)
+        else:
+            element.setElement(name, value)
+
+
+class ShardClient:
+
+    # Calls into the parent process. Calls can be made from any thread of the shard;
+    # a reader thread hands each response to the caller waiting for it.
+
+    def __init__(self, shard, calls, responses):
+
+        self.shard = shard
+        self.calls = calls
+        self.responses = responses
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.thread = threading.Thread(target=self.run, name="RMSXShardClient", daemon=True)
+        self.thread.start()
+
+    def call(self, kind, payload):
+
+        future = Future()
+        with self.lock:
+            self.next_id += 1
+            call_id = self.next_id
+            self.pending[call_id] = future
+
+        self.calls.put((self.shard, call_id, kind, payload))
+        return future.result()
+
+    def run(self):
+
+        while True:
+            response = self.responses.get()
+            if response is None:
+                break
+            call_id, ok, result = response
+            with self.lock:
+                future = self.pending.pop(call_id)
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(result))
+
+    def stop(self):
+
+        self.responses.put(None)
+        self.thread.join()
+
+
+class ShardEasyMKT(ReplayEasyMKT):
+
+    def __init__(self, client):
+
+        super().__init__({})
+        self.client = client
+
+    def send_request(self, req):
+
+        self.requests += 1
+        security_data = self.client.call("refdata", (req.values.get("securities", []), req.values.get("fields", [])))
+        return ReplayMessage("ReferenceDataResponse", {"securityData": security_data})
+
+
+class ShardEasyMSX(ReplayEasyMSX):
+
+    # Applies the events forwarded by the parent. start() returns once the initial
+    # paint is complete, so the demo prefetches its reference data in one batch.
+
+    def __init__(self, events, client):
+
+        super().__init__([], 0, 0, 0)
+        self.events = events
+        self.client = client
+        self.stopped = False
+        self.requests_sent = 0
+
+    def start(self):
+        self.run(PAINTED)
+
+    def run(self, until=None):
+
+        while not self.stopped:
+            event = self.events.get()
+            if event is None:
+                self.stopped = True
+            elif event == until:
+                return
+            else:
+                try:
+                    self.apply(event)
+                except Exception as e:
+                    log("Failed to apply %s %s event: %s", event["category"], event["type"], e, level=logging.ERROR)
+
+    def send_request(self, req):
+
+        # Only counted; a live shard would otherwise keep every request it ever sent
+        with self.lock:
+            self.requests_sent += 1
+        message_type, fields = self.client.call("request", (req.name, req.values))
+        return ReplayMessage(message_type, fields)
+
+
+def run_shard(shard, options, events, calls, responses):
+
+    demo.LOGGER.configure(logging.getLevelName(options.log_level), not options.no_console, options.log_file)
+    log("Shard %d started", shard, pid=os.getpid())
+
+    client = ShardClient(shard, calls, responses)
+    easymsx = ShardEasyMSX(events, client)
+    rmsx = demo.RMSXSimpleStockHedgeDemo(options, easymsx, ShardEasyMKT(client))
+    easymsx.run()
+
+    log("Shard %d stopping: %d notifications, %d requests sent", shard, easymsx.notifications, easymsx.requests_sent)
+    rmsx.stop()
+    client.stop()
+    demo.LOGGER.stop()
+
+
+class ShardedStockHedgeDemo:
+
+    FORWARDED_TYPES = frozenset([
+        EasyMSXNotification.NotificationType.NEW,
+        EasyMSXNotification.NotificationType.INITIALPAINT,
+        EasyMSXNotification.NotificationType.UPDATE,
+        EasyMSXNotification.NotificationType.DELETE])
+
+    def __init__(self, options, shards, easymsx=None, easymkt=None):
+
+        # easymsx/easymkt may be given to run against another backend (see RMSXSimpleStockHedgeReplay.py)
+
+        self.options = options
+        self.shards = max(1, shards)
+        self.recorder = None
+        if options.record is not None:
+            self.recorder = demo.NotificationRecorder(options.record)
+        self.forwarded = [0] * self.shards
+        self.served = {}
+        self.served_lock = threading.Lock()
+        if options.snapshot is not None:
+            self.check_snapshots(options.snapshot)
+
+        # spawn rather than fork, as the parent may already have Bloomberg session threads
+        context = multiprocessing.get_context("spawn")
+        self.calls = context.Queue()
+        self.events = [context.Queue() for shard in range(self.shards)]
+        self.responses = [context.Queue() for shard in range(self.shards)]
+        self.processes = []
+
+        log("Starting %d shards...", self.shards)
+        for shard in range(self.shards):
+            process = context.Process(target=run_shard, args=(shard, shard_options(options, shard, self.shards), self.events[shard], self.calls, self.responses[shard]), name="RMSXShard%d" % shard, daemon=True)
+            process.start()
+            self.processes.append(process)
+
+        log("Initialising EasyMKT...")
+        self.easymkt = easymkt if easymkt is not None else EasyMKT()
+        self.refdata = demo.RefDataCache(self.easymkt, options.refdata_ttl, options.refdata_batch, self.recorder)
+        log("EasyMKT initialised...")
+
+        self.executor = ThreadPoolExecutor(max_workers=max(1, options.dispatch_workers), thread_name_prefix="RMSXShardCalls")
+        self.collector = threading.Thread(target=self.collect, name="RMSXShardCollector", daemon=True)
+        self.collector.start()
+
+        log("Initialising EasyMSX...")
+        self.easymsx = easymsx if easymsx is not None else EasyMSX()
+        log("EasyMSX initialised...")
+
+        self.easymsx.orders.add_notification_handler(self.process_notification)
+        self.easymsx.routes.add_notification_handler(self.process_notification)
+
+        log("Starting EasyMSX...")
+        self.easymsx.start()
+        log("EasyMSX started.")
+
+        for events in self.events:
+            events.put(PAINTED)
+
+    def stop(self):
+
+        for events in self.events:
+            events.put(None)
+        for process in self.processes:
+            process.join()
+
+        # Every shard has had all of its calls answered before it exits
+        self.calls.put(None)
+        self.collector.join()
+        self.executor.shutdown(wait=True)
+
+        log("Shards: %s notifications forwarded, %s", "/".join([str(n) for n in self.forwarded]), ", ".join(["%d %s calls" % (n, kind) for kind, n in sorted(self.served.items())]))
+        if self.recorder is not None:
+            self.recorder.stop()
+
+    def check_snapshots(self, path):
+        
+        # Refused before any shard starts: with a different shard count, orders would
+        # land on shards whose snapshot has no fill history for them and be hedged again
+        shard = 0
+        while True:
+            written_by = demo.WarmStartSnapshot.written_by("%s.%d" % (path, shard))
+            if written_by is False and shard >= self.shards:
+                return
+            if written_by is not False and tuple(written_by or ()) != (shard, self.shards):
+                raise ValueError("Snapshot %s.%d was written %s, not by shard %d of %d - restart with the same --shards or new snapshot files" % (path, shard, demo.WarmStartSnapshot.describe(written_by), shard, self.shards))
+            shard += 1
+
+    def shard_for(self, sequence):
+        return int(sequence) % self.shards
+
+    def process_notification(self, notification):
+
+        if not notification.type in self.FORWARDED_TYPES:
+            return
+
+        if notification.category == EasyMSXNotification.NotificationCategory.ORDER:
+            field_names, key_names = demo.RMSXSimpleStockHedgeDemo.ORDER_FIELDS, ["EMSX_SEQUENCE"]
+        elif notification.category == EasyMSXNotification.NotificationCategory.ROUTE:
+            field_names, key_names = demo.RMSXSimpleStockHedgeDemo.ROUTE_FIELDS, ["EMSX_SEQUENCE", "EMSX_ROUTE_ID"]
+        else:
+            return
+
+        if self.recorder is not None:
+            self.recorder.record(notification, field_names, key_names)
+
+        event = demo.notification_event(notification, field_names, key_names)
+        shard = self.shard_for(event["fields"]["EMSX_SEQUENCE"])
+        self.forwarded[shard] += 1
+        self.events[shard].put(event)
+
+    def collect(self):
+
+        while True:
+            call = self.calls.get()
+            if call is None:
+                break
+            self.executor.submit(self.serve, *call)
+
+    def serve(self, shard, call_id, kind, payload):
+
+        try:
+            if kind == "refdata":
+                result = self.serve_refdata(*payload)
+            elif kind == "request":
+                result = self.serve_request(*payload)
+            else:
+                raise ValueError("Unknown shard call: " + kind)
+            response = (call_id, True, result)
+        except Exception as e:
+            log("Shard %d %s call failed: %s", shard, kind, e, level=logging.ERROR)
+            response = (call_id, False, str(e))
+
+        with self.served_lock:
+            self.served[kind] = self.served.get(kind, 0) + 1
+        self.responses[shard].put(response)
+
+    def serve_refdata(self, tickers, fields):
+
+        # Answered from the shared cache, so a security is only requested once for all shards
+        self.refdata.prefetch(tickers, fields)
+
+        security_data = []
+        for ticker in tickers:
+            field_data = {}
+            for field in fields:
+                value = self.refdata.get(ticker, field)
+                if value is not None:
+                    field_data[field] = value
+            security_data.append({"security": ticker, "fieldData": field_data})
+        return security_data
+
+    def serve_request(self, request_name, values):
+
+        req = self.easymsx.create_request(request_name)
+        apply_request(req, values)
+        msg = self.easymsx.send_request(req)
+
+        message_type = str(msg.messageType())
+        if message_type == "ErrorInfo":
+            return message_type, {"ERROR_CODE": msg.getElementAsInteger("ERROR_CODE"), "ERROR_MESSAGE": msg.getElementAsString("ERROR_MESSAGE")}
+        return message_type, {}
+
+
+if __name__ == '__main__':
+
+    shards, options = parseCommandLine()
+
+    demo.LOGGER.configure(logging.getLevelName(options.log_level), not options.no_console, options.log_file)
+
+    rmsx = ShardedStockHedgeDemo(options, shards)
+
+    input("Press any to terminate\n")
+
+    log("Terminating...")
+
+    rmsx.stop()
+    demo.LOGGER.stop()
+
+    quit()